@@ -0,0 +1,84 @@
+"""
+Helpers shared by the benchmark scripts: synthetic bigWig, fasta and bed
+files written in a temporary directory, and a timer.
+
+The scripts are run from the root of the repository, e.g.
+    python benchmarks/bench_bigwig_pool.py
+"""
+import os
+import sys
+import time
+import tempfile
+
+import numpy as np
+import pyBigWig
+
+# the scripts import the keras_dna of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def temporary_directory():
+    return tempfile.TemporaryDirectory(prefix='keras_dna_bench_')
+
+
+def make_bigwig(path, chrom_sizes, seed=0, span=10):
+    """Writes a bigWig with a random coverage by steps of span bases."""
+    rng = np.random.default_rng(seed)
+    bw = pyBigWig.open(path, 'w')
+    bw.addHeader(list(chrom_sizes.items()), maxZooms=10)
+
+    for chrom, size in chrom_sizes.items():
+        nb_values = size // span
+        bw.addEntries(chrom, 0,
+                      values=rng.random(nb_values).astype(np.float64).tolist(),
+                      span=span,
+                      step=span)
+    bw.close()
+    return path
+
+
+def make_bigwigs(directory, nb_files, chrom_sizes):
+    return [make_bigwig(os.path.join(directory, 'track{}.bw'.format(i)),
+                        chrom_sizes,
+                        seed=i) for i in range(nb_files)]
+
+
+def make_fasta(path, chrom_sizes, seed=0):
+    rng = np.random.default_rng(seed)
+    with open(path, 'w') as fasta:
+        for chrom, size in chrom_sizes.items():
+            seq = np.frombuffer(b'ACGT', dtype=np.uint8)[rng.integers(0, 4, size)]
+            fasta.write('>{}\n'.format(chrom))
+            for start in range(0, size, 60):
+                fasta.write(seq[start : start + 60].tobytes().decode() + '\n')
+    return path
+
+
+def make_bed(path, chrom_sizes, nb_features, length=100, seed=0):
+    rng = np.random.default_rng(seed)
+    with open(path, 'w') as bed:
+        for chrom, size in chrom_sizes.items():
+            starts = np.sort(rng.integers(length, size - 2 * length, nb_features))
+            for start in starts:
+                bed.write('{}\t{}\t{}\tfeature\t0\t+\n'.format(chrom,
+                                                              start,
+                                                              start + length))
+    return path
+
+
+def timeit(function, repeat=5):
+    """Returns the median time of function in ms (after one warm up call)."""
+    function()
+    times = list()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return 1000 * float(np.median(times))
+
+
+def report(name, before, after):
+    print('{:<48} before {:>10.2f} ms   after {:>10.2f} ms   x{:.1f}'.format(name,
+                                                                        before,
+                                                                        after,
+                                                                        before / after))
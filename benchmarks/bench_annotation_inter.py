@@ -0,0 +1,91 @@
+"""
+SparseDataset._annotation_inter with the sorted sweep against the n x n
+distance matrices of the previous version, time and peak memory (traced
+by tracemalloc) for n annotations on one chromosome.
+"""
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from _common import timeit, report
+from keras_dna.sequence import SparseDataset
+
+
+def annotation_inter_matrices(dataset):
+    """The _annotation_inter of the baseline (match_all)."""
+    inter_dict = {}
+
+    for chrom in dataset.ann_df.chrom.unique():
+        local_df = dataset.ann_df[dataset.ann_df.chrom == chrom]
+        starts = local_df.start.values
+        stops = local_df.stop.values
+        mat_ann_start = np.repeat(starts,
+                                  len(starts)).reshape((len(starts),
+                                                        len(starts)))
+        mat_ann_stop = np.repeat(stops,
+                                 len(stops)).reshape((len(starts),
+                                                      len(starts)))
+        A = np.minimum(np.abs(mat_ann_stop - mat_ann_stop.T),
+                       np.abs(mat_ann_start - mat_ann_start.T))
+        m = A.shape[0]
+        strided = np.lib.stride_tricks.as_strided
+        s0, s1 = A.strides
+        out = strided(A.ravel()[1:],
+                      shape=(m - 1, m),
+                      strides=(s0 + s1, s1)).reshape(m, -1)
+        if dataset.data_augmentation:
+            indexes = np.where(out <= dataset.length)[0]
+        else:
+            indexes = np.where(out <= dataset.length // 2)[0]
+
+        inter_indexes = np.unique(indexes)
+        inter_dict[chrom] = [np.delete(np.arange(len(starts)), inter_indexes),
+                             inter_indexes]
+    return inter_dict
+
+
+def make_dataset(nb_annotations, seed=0):
+    """A SparseDataset with only the attributes used by _annotation_inter."""
+    rng = np.random.default_rng(seed)
+    starts = np.sort(rng.integers(0, 200 * nb_annotations, nb_annotations))
+    dataset = object.__new__(SparseDataset)
+    dataset.ann_df = pd.DataFrame({'chrom' : 'chr1',
+                                   'start' : starts,
+                                   'stop' : starts + rng.integers(50, 500,
+                                                                  nb_annotations)})
+    dataset.defined_positive = 'match_all'
+    dataset.data_augmentation = False
+    dataset.length = 200
+    return dataset
+
+
+def peak_memory(function):
+    """Returns the peak of the memory allocated by function in MB."""
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 10 ** 6
+
+
+def main():
+    for nb_annotations in (1000, 2000, 4000):
+        dataset = make_dataset(nb_annotations)
+        matrices = annotation_inter_matrices(dataset)['chr1']
+        sweep = dataset._annotation_inter()['chr1']
+        assert all(np.array_equal(left, right) for left, right in zip(matrices, sweep))
+
+        before = timeit(lambda: annotation_inter_matrices(dataset), repeat=3)
+        after = timeit(dataset._annotation_inter, repeat=3)
+        report('{} annotations'.format(nb_annotations), before, after)
+
+        before = peak_memory(lambda: annotation_inter_matrices(dataset))
+        after = peak_memory(dataset._annotation_inter)
+        print('{:<48} before {:>10.2f} MB   after {:>10.2f} MB'.format('  peak memory',
+                                                                     before,
+                                                                     after))
+
+
+if __name__ == '__main__':
+    main()
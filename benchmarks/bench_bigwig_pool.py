@@ -0,0 +1,47 @@
+"""
+bbi_extractor.extract with the handles kept open by a BigWigPool, against
+the previous behaviour that opened every bigWig file for every interval.
+
+256 intervals of 1 kb over 8 bigWig files.
+"""
+from collections import namedtuple
+
+import numpy as np
+import pyBigWig
+
+from _common import temporary_directory, make_bigwigs, timeit, report
+from keras_dna.extractors import bbi_extractor
+
+Interval = namedtuple('Interval', ['chrom', 'start', 'stop'])
+CHROM_SIZES = {'chr1' : 5 * 10 ** 6, 'chr2' : 5 * 10 ** 6}
+
+
+def extract_reopening(bbi_files, interval):
+    """The extraction of the baseline: one pyBigWig.open per file and interval."""
+    seq = list()
+    for bbi_file in bbi_files:
+        bw = pyBigWig.open(bbi_file)
+        array = bw.values(interval.chrom, interval.start, interval.stop, numpy=True)
+        array[np.isnan(array)] = 0
+        seq.append(array)
+        bw.close()
+    return np.array(seq).T
+
+
+def main():
+    rng = np.random.default_rng(0)
+    with temporary_directory() as directory:
+        bbi_files = make_bigwigs(directory, 8, CHROM_SIZES)
+        starts = rng.integers(0, CHROM_SIZES['chr1'] - 1000, 256)
+        intervals = [Interval('chr1', int(start), int(start) + 1000) for start in starts]
+        extractor = bbi_extractor(bbi_files, 1000)
+
+        before = timeit(lambda: [extract_reopening(bbi_files, interval)\
+                                 for interval in intervals])
+        after = timeit(lambda: [extractor.extract(interval) for interval in intervals])
+        report('256 x 1 kb, 8 files, per batch', before, after)
+        extractor.close()
+
+
+if __name__ == '__main__':
+    main()
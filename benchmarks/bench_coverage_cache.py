@@ -0,0 +1,42 @@
+"""
+bbi_extractor with cache_coverage=True (the chromosomes are read once and
+sliced) against the reading of the bigWig files for every batch.
+
+512 windows of 1 kb over 4 tracks, timed once the chromosome is cached.
+"""
+import numpy as np
+
+from _common import temporary_directory, make_bigwigs, timeit, report
+from keras_dna.extractors import bbi_extractor
+from keras_dna.intervals import IntervalBatch
+
+CHROM_SIZES = {'chr1' : 5 * 10 ** 6}
+
+
+def main():
+    rng = np.random.default_rng(0)
+    with temporary_directory() as directory:
+        bbi_files = make_bigwigs(directory, 4, CHROM_SIZES)
+        starts = rng.integers(0, CHROM_SIZES['chr1'] - 1000, 512)
+        intervals = IntervalBatch(np.array(['chr1']),
+                                  np.zeros(512, dtype=np.int64),
+                                  starts,
+                                  starts + 1000)
+
+        reading = bbi_extractor(bbi_files, 1000)
+        caching = bbi_extractor(bbi_files, 1000, cache_coverage=True)
+        assert np.allclose(reading.extract_batch(intervals),
+                           caching.extract_batch(intervals))
+
+        before = timeit(lambda: reading.extract_intervals(intervals))
+        after = timeit(lambda: caching.extract_batch(intervals))
+        report('512 x 1 kb, 4 tracks, per batch', before, after)
+
+        before = timeit(lambda: reading.extract_batch(intervals))
+        report('same, against extract_batch without cache', before, after)
+        reading.close()
+        caching.close()
+
+
+if __name__ == '__main__':
+    main()
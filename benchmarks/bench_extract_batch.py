@@ -0,0 +1,45 @@
+"""
+bbi_extractor.extract_batch (sorted and merged reads, one gather per read)
+against extracting the intervals one by one.
+
+512 intervals of 1 kb over 4 tracks, sampling_mode='mean' on 100 bins,
+with random windows and with overlapping windows (one base apart).
+"""
+import numpy as np
+
+from _common import temporary_directory, make_bigwigs, timeit, report
+from keras_dna.extractors import bbi_extractor
+from keras_dna.intervals import IntervalBatch
+
+CHROM_SIZES = {'chr1' : 5 * 10 ** 6}
+
+
+def batch(starts):
+    return IntervalBatch(np.array(['chr1']),
+                         np.zeros(len(starts), dtype=np.int64),
+                         starts,
+                         starts + 1000)
+
+
+def main():
+    rng = np.random.default_rng(0)
+    with temporary_directory() as directory:
+        bbi_files = make_bigwigs(directory, 4, CHROM_SIZES)
+        extractor = bbi_extractor(bbi_files, 100, sampling_mode='mean')
+
+        random_windows = batch(rng.integers(0, CHROM_SIZES['chr1'] - 1000, 512))
+        overlapping_windows = batch(10 ** 6 + np.arange(512))
+
+        for name, intervals in (('random windows', random_windows),
+                                ('overlapping windows', overlapping_windows)):
+            assert np.allclose(extractor.extract_intervals(intervals),
+                               extractor.extract_batch(intervals),
+                               atol=1e-6)
+            before = timeit(lambda: extractor.extract_intervals(intervals))
+            after = timeit(lambda: extractor.extract_batch(intervals))
+            report('512 x 1 kb, 4 tracks, mean, ' + name, before, after)
+        extractor.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""
+ContinuousDataset._get_intervals (binary search on last_index) against the
+previous lookup, a sign product over all the rows and a df.iloc for every
+index.
+
+256 lookups over 5,000 scaffolds.
+"""
+import os
+
+import numpy as np
+import pybedtools
+
+from _common import temporary_directory, timeit, report
+from keras_dna.sequence import ContinuousDataset
+
+
+def get_interval_scan(dataset, idx):
+    """The lookup of the baseline."""
+    df = dataset.df
+    indicative_mat = (np.sign(df.first_index.values - idx)) *\
+                     (np.sign(df.last_index.values - idx))
+    df_idx = np.where(indicative_mat <= 0)[0][-1]
+
+    row = df.iloc[df_idx]
+    start = row.start + (idx - row.first_index) * dataset.asteps - dataset.hw
+    stop = row.start + (idx - row.first_index) * dataset.asteps +\
+    dataset.hw + (dataset.window % 2)
+    return pybedtools.create_interval_from_list([row.chrom, int(start), int(stop)])
+
+
+def main():
+    rng = np.random.default_rng(0)
+    with temporary_directory() as directory:
+        sizes_file = os.path.join(directory, 'genome.sizes')
+        with open(sizes_file, 'w') as sizes:
+            for i, size in enumerate(rng.integers(2000, 200000, 5000)):
+                sizes.write('scaffold{}\t{}\n'.format(i, size))
+
+        dataset = ContinuousDataset(sizes_file,
+                                    window=1000,
+                                    excl_chromosomes=[],
+                                    ignore_targets=True)
+        idx = rng.integers(0, len(dataset), 256)
+
+        batch = dataset._get_intervals(idx)
+        assert all(get_interval_scan(dataset, i).start == start\
+                   for i, start in zip(idx, batch.starts))
+
+        before = timeit(lambda: [get_interval_scan(dataset, i) for i in idx])
+        after = timeit(lambda: dataset._get_intervals(idx))
+        report('256 lookups over 5,000 scaffolds', before, after)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,34 @@
+"""
+One-hot encoding of a batch with BatchOneHot (one lookup table gather)
+against ReorderedOneHot called on every sequence, as SeqIntervalDl did.
+
+512 sequences of 1 kb.
+"""
+import numpy as np
+
+from _common import timeit, report
+from kipoiseq.transforms import ReorderedOneHot
+from keras_dna.sequence import BatchOneHot
+
+
+def main():
+    rng = np.random.default_rng(0)
+    letters = np.frombuffer(b'ACGTN', dtype=np.uint8)
+    seqs = letters[rng.integers(0, 5, (512, 1000))]
+    str_seqs = [seq.tobytes().decode() for seq in seqs]
+
+    transform = ReorderedOneHot(alphabet='ACGT')
+    encoder = BatchOneHot(alphabet='ACGT')
+    assert np.array_equal(np.array([transform(seq) for seq in str_seqs]),
+                          encoder(str_seqs))
+
+    before = timeit(lambda: np.array([transform(seq) for seq in str_seqs]))
+    after = timeit(lambda: encoder(str_seqs))
+    report('512 x 1 kb strings, per batch', before, after)
+
+    after = timeit(lambda: encoder(seqs))
+    report('512 x 1 kb uint8 (genome directory), per batch', before, after)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""
+bbi_extractor with approximate_sampling=True (means read from the zoom
+levels of the bigWig files) against the base resolution coverage averaged
+on the bins.
+
+64 windows of 50 kb averaged on 100 bins, 1 track. The files are local and
+in the page cache: the summaries reduce the amount of data read, which
+matters for distant files, but pyBigWig computes every bin separately. This
+is why bbi_extractor only uses them with remote files, the benchmark forces
+them on local files.
+"""
+import warnings
+
+import numpy as np
+
+from _common import temporary_directory, make_bigwigs, timeit, report
+from keras_dna.extractors import bbi_extractor, zoom_levels
+from keras_dna.intervals import IntervalBatch
+
+CHROM_SIZES = {'chr1' : 2 * 10 ** 7}
+
+
+def main():
+    rng = np.random.default_rng(0)
+    with temporary_directory() as directory:
+        bbi_files = make_bigwigs(directory, 1, CHROM_SIZES)
+        starts = rng.integers(0, CHROM_SIZES['chr1'] - 50000, 64)
+        intervals = IntervalBatch(np.array(['chr1']),
+                                  np.zeros(64, dtype=np.int64),
+                                  starts,
+                                  starts + 50000)
+
+        exact = bbi_extractor(bbi_files, 100, sampling_mode='mean')
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            approximate = bbi_extractor(bbi_files, 100,
+                                        sampling_mode='mean',
+                                        approximate_sampling=True)
+        ### Local files are read at base resolution, force the summaries.
+        approximate.use_zoom_levels = True
+        approximate.min_zoom_level = max([min(zoom_levels(bbi_file) or [np.inf])\
+                                          for bbi_file in bbi_files])
+
+        before = timeit(lambda: exact.extract_batch(intervals))
+        after = timeit(lambda: approximate.extract_batch(intervals))
+        report('64 x 50 kb, 100 bins, per batch', before, after)
+        exact.close()
+        approximate.close()
+
+
+if __name__ == '__main__':
+    main()
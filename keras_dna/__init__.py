@@ -4,6 +4,7 @@ from . import evaluation
 from . import normalization
 from . import extractors
 from . import generators
+from . import intervals
 from . import layers
 from . import model
 from . import utils
@@ -6,18 +6,766 @@ Created on Tue Nov  5 16:37:22 2019
 @author: routhier
 """
 
+import os
+import gzip
+import json
+import uuid
+import struct
+import tempfile
+import threading
+import weakref
+import urllib.request
 import numpy as np
 import pyBigWig
 import warnings
+from collections import OrderedDict
 
 
-from kipoiseq.transforms.functional import resize_interval
+from kipoiseq.extractors import FastaStringExtractor
 
 
-from .utils import rolling_window
+from .utils import rolling_window, COMPLEMENT, UPPER
+from .intervals import RegionIndex, merge_intervals
 from .normalization import Normalizer, BiNormalizer
 
 
+class BigWigPool(object):
+    """
+    Keeps the pyBigWig handles open between two extractions. The files are
+    opened lazily the first time they are needed. The handles are never
+    shared between processes: after a fork the pool is emptied and the files
+    are opened again in the child. Every thread has its own handles because
+    a handle reads through a single file offset.
+
+    A single LRU keyed by (thread, file) holds the handles of all the
+    threads. When more than max_open_files are open, the handles of the
+    threads that have ended are closed first, then the least recently used
+    handles of the calling thread (the handles of the other live threads may
+    be in use and are left open).
+
+    args:
+        max_open_files:
+            The maximal number of files kept open at the same time by all
+            the threads, None for no limit.
+            default=64
+    """
+    def __init__(self, max_open_files=64):
+        self.max_open_files = max_open_files
+        self._handles = OrderedDict()
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            # the handles were inherited from the parent process, the file
+            # offset is shared with it so they must not be used.
+            self._lock = threading.Lock()
+            self.close()
+            self._pid = os.getpid()
+
+    def __getitem__(self, bbi_file):
+        self._check_pid()
+        thread = threading.current_thread()
+        key = (thread.ident, bbi_file)
+
+        with self._lock:
+            if key in self._handles:
+                self._handles.move_to_end(key)
+                thread_ref, bw = self._handles[key]
+                if thread_ref() is not thread:
+                    # a thread identifier is reused once its thread has ended
+                    self._handles[key] = (weakref.ref(thread), bw)
+                return bw
+
+            bw = pyBigWig.open(bbi_file)
+            self._handles[key] = (weakref.ref(thread), bw)
+
+            if self.max_open_files and len(self._handles) > self.max_open_files:
+                self._evict(thread)
+        return bw
+
+    def _evict(self, thread):
+        """Closes the handles that can be closed until the cap is reached."""
+        for key, (thread_ref, bw) in list(self._handles.items()):
+            if len(self._handles) <= self.max_open_files:
+                return
+            owner = thread_ref()
+            if owner is None or not owner.is_alive():
+                del self._handles[key]
+                bw.close()
+
+        # the most recent handle is the one being returned
+        for key, (thread_ref, bw) in list(self._handles.items())[:-1]:
+            if len(self._handles) <= self.max_open_files:
+                return
+            if thread_ref() is thread:
+                del self._handles[key]
+                bw.close()
+
+    def __len__(self):
+        return len(self._handles)
+
+    def close(self):
+        """Closes all the open handles of every thread."""
+        with self._lock:
+            while self._handles:
+                _, (_, bw) = self._handles.popitem()
+                bw.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def __getstate__(self):
+        return {'max_open_files' : self.max_open_files}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+
+_fasta_extractors = {'pid' : None, 'extractors' : dict()}
+
+
+def get_fasta_extractor(fasta_file, use_strand=False, force_upper=False):
+    """
+    Returns a FastaStringExtractor shared by every dataloader of the process.
+    The extractor is created on first use and kept for the next calls with
+    the same arguments so that the fasta file and its index are only read
+    once. The cache is emptied after a fork.
+    """
+    if _fasta_extractors['pid'] != os.getpid():
+        for extractor in _fasta_extractors['extractors'].values():
+            try:
+                extractor.close()
+            except Exception:
+                pass
+        _fasta_extractors['extractors'] = dict()
+        _fasta_extractors['pid'] = os.getpid()
+
+    key = (fasta_file, use_strand, force_upper)
+    if key not in _fasta_extractors['extractors']:
+        _fasta_extractors['extractors'][key] = FastaStringExtractor(fasta_file,
+                                                                    use_strand=use_strand,
+                                                                    force_upper=force_upper)
+    return _fasta_extractors['extractors'][key]
+
+
+def compile_genome(fasta_file, genome_dir=None):
+    """
+    Converts a fasta file into a genome directory readable by GenomeArray.
+    The sequences are written one after the other as a flat uint8 array (the
+    ASCII code of every base, soft-masking and N are kept) with a small json
+    index giving the offset and the size of every chromosome. The conversion
+    is done once, the directory can then be passed as fasta_file to the
+    dataloaders.
+
+    args:
+        fasta_file:
+            The fasta file to convert (can be gzipped).
+        genome_dir:
+            The directory where to write the genome, default is the fasta
+            file name with the extension .genome
+    returns:
+        The path to the genome directory.
+    """
+    if genome_dir is None:
+        genome_dir = fasta_file[:-3] if fasta_file.endswith('.gz') else fasta_file
+        genome_dir = os.path.splitext(genome_dir)[0] + '.genome'
+    os.makedirs(genome_dir, exist_ok=True)
+
+    opener = gzip.open if fasta_file.endswith('.gz') else open
+    index = OrderedDict()
+    name = None
+    offset = 0
+    chrom_offset = 0
+
+    with opener(fasta_file, 'rb') as fasta,\
+    open(os.path.join(genome_dir, GenomeArray.data_file), 'wb') as data:
+        for line in fasta:
+            if line.startswith(b'>'):
+                if name is not None:
+                    index[name] = [chrom_offset, offset - chrom_offset]
+                name = line[1:].split()[0].decode()
+                chrom_offset = offset
+            else:
+                line = line.rstrip()
+                data.write(line)
+                offset += len(line)
+
+        if name is not None:
+            index[name] = [chrom_offset, offset - chrom_offset]
+
+    # the index is written last so that an interrupted conversion is not
+    # taken for a genome.
+    with open(os.path.join(genome_dir, GenomeArray.index_file), 'w') as index_file:
+        json.dump(index, index_file)
+    return genome_dir
+
+
+class GenomeArray(object):
+    """
+    Reads the DNA sequence from a genome directory written by compile_genome.
+    The genome is memory mapped and the sequences are taken by slicing, they
+    are returned as uint8 arrays of ASCII codes (extract_array, extract_batch)
+    or as strings (extract) to be used in place of a FastaStringExtractor.
+
+    args:
+        genome_dir:
+            The directory written by compile_genome.
+        use_strand:
+            If True, the sequence of intervals on the '-' strand is reverse
+            complemented.
+            default=False
+        force_upper:
+            Force uppercase output of sequences.
+            default=False
+    """
+    index_file = 'index.json'
+    data_file = 'sequence.u1'
+
+    def __init__(self,
+                 genome_dir,
+                 use_strand=False,
+                 force_upper=False):
+        self.genome_dir = genome_dir
+        self.use_strand = use_strand
+        self.force_upper = force_upper
+
+        with open(os.path.join(genome_dir, self.index_file), 'r') as index_file:
+            index = json.load(index_file, object_pairs_hook=OrderedDict)
+        self.offsets = {name : offset for name, (offset, _) in index.items()}
+        self.sizes = OrderedDict([(name, size) for name, (_, size) in index.items()])
+        self.data = np.memmap(os.path.join(genome_dir, self.data_file),
+                              dtype=np.uint8,
+                              mode='r')
+
+    @staticmethod
+    def is_genome(path):
+        """Returns True if path is a directory written by compile_genome."""
+        return isinstance(path, str) and\
+        os.path.isfile(os.path.join(path, GenomeArray.index_file))
+
+    def chroms(self):
+        return dict(self.sizes)
+
+    def __getstate__(self):
+        # the memory map is opened again instead of being copied
+        return {'genome_dir' : self.genome_dir,
+                'use_strand' : self.use_strand,
+                'force_upper' : self.force_upper}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def extract_array(self, interval):
+        """
+        Returns the sequence of the interval as a uint8 array of ASCII codes,
+        a view on the genome when no transformation is needed.
+        """
+        offset = self.offsets[interval.chrom]
+        seq = self.data[offset + interval.start : offset + interval.stop]
+
+        if self.use_strand and interval.strand == '-':
+            seq = COMPLEMENT[seq[::-1]]
+        if self.force_upper:
+            seq = UPPER[seq]
+        return seq
+
+    def extract(self, interval):
+        """Returns the sequence of the interval as a string."""
+        return self.extract_array(interval).tobytes().decode()
+
+    def extract_batch(self,
+                      chroms,
+                      starts,
+                      stops,
+                      strands=None,
+                      length=None):
+        """
+        Extracts a batch of sequences at once.
+
+        Sequences shorter than length are padded with N and longer ones are
+        trimmed (both anchored at the center, as kipoiseq.fixed_len). Bases
+        outside of the chromosome are returned as N.
+
+        returns:
+            np.array of shape (batch, length) and type uint8
+        """
+        chrom_names, chroms = np.unique(np.asarray(chroms).astype(str),
+                                        return_inverse=True)
+        offsets = np.array([self.offsets[chrom] for chrom in chrom_names],
+                           dtype=np.int64)[chroms]
+        sizes = np.array([self.sizes[chrom] for chrom in chrom_names],
+                         dtype=np.int64)[chroms]
+
+        starts = np.asarray(starts, dtype=np.int64)
+        stops = np.asarray(stops, dtype=np.int64)
+        lengths = stops - starts
+
+        if length is None:
+            length = int(np.max(lengths)) if len(lengths) else 0
+
+        diff = length - lengths
+        shift = np.where(diff >= 0, diff // 2 + diff % 2, - ((- diff) // 2 + (- diff) % 2))
+        position = np.arange(length)[np.newaxis] - shift[:, np.newaxis]
+
+        if self.use_strand and strands is not None:
+            minus = (np.asarray(strands) == '-')[:, np.newaxis]
+        else:
+            minus = np.zeros((len(starts), 1), dtype=bool)
+
+        genomic = np.where(minus,
+                           stops[:, np.newaxis] - 1 - position,
+                           starts[:, np.newaxis] + position)
+        valid = (position >= 0) & (position < lengths[:, np.newaxis])
+        valid &= (genomic >= 0) & (genomic < sizes[:, np.newaxis])
+
+        seqs = np.full((len(starts), length), ord('N'), dtype=np.uint8)
+        seqs[valid] = self.data[(offsets[:, np.newaxis] + genomic)[valid]]
+        seqs = np.where(minus, COMPLEMENT[seqs], seqs)
+
+        if self.force_upper:
+            seqs = UPPER[seqs]
+        return seqs
+
+    def extract_intervals(self, intervals, length=None):
+        """Same as extract_batch for an IntervalBatch."""
+        return self.extract_batch(intervals.chrom,
+                                  intervals.starts,
+                                  intervals.stops,
+                                  intervals.strands,
+                                  length)
+
+
+def _iter_sequences(fasta_file):
+    """
+    Yields the name and the sequence (uint8 array of ASCII codes) of every
+    chromosome of a fasta file (can be gzipped) or of a genome directory.
+    """
+    if GenomeArray.is_genome(fasta_file):
+        genome = GenomeArray(fasta_file)
+        for name, size in genome.sizes.items():
+            offset = genome.offsets[name]
+            yield name, np.asarray(genome.data[offset : offset + size])
+        return
+
+    opener = gzip.open if fasta_file.endswith('.gz') else open
+    name = None
+    lines = list()
+
+    with opener(fasta_file, 'rb') as fasta:
+        for line in fasta:
+            if line.startswith(b'>'):
+                if name is not None:
+                    yield name, np.frombuffer(b''.join(lines), dtype=np.uint8)
+                name = line[1:].split()[0].decode()
+                lines = list()
+            else:
+                lines.append(line.rstrip())
+
+    if name is not None:
+        yield name, np.frombuffer(b''.join(lines), dtype=np.uint8)
+
+
+def compile_gc_index(fasta_file,
+                     bin_size=100,
+                     mappability_file=None,
+                     index_dir=None):
+    """
+    Computes once per genome the number of G or C and the number of A, C, G
+    or T (not N) in every bin of bin_size bases, and optionally the mean
+    mappability of the bins read from a bigWig file. The index is written in
+    a directory readable by GCIndex, it is not computed again if the
+    directory already holds an index.
+
+    args:
+        fasta_file:
+            The fasta file (can be gzipped) or a genome directory written by
+            compile_genome.
+        bin_size:
+            The number of bases in a bin (smaller than 2 ** 16).
+            default=100
+        mappability_file:
+            A bigWig file with the mappability of the genome (between 0 and
+            1).
+            default=None
+        index_dir:
+            The directory where to write the index, default is the fasta file
+            name with the extension .gc<bin_size> (and the name of the
+            mappability file).
+    returns:
+        The path to the index directory.
+    """
+    assert bin_size < 2 ** 16, """bin_size must be smaller than 2 ** 16"""
+
+    if index_dir is None:
+        index_dir = fasta_file[:-3] if fasta_file.endswith('.gz') else fasta_file
+        index_dir = os.path.splitext(index_dir.rstrip('/'))[0] + '.gc{}'.format(bin_size)
+        if mappability_file is not None:
+            index_dir += '.' + os.path.splitext(os.path.basename(mappability_file))[0]
+
+    if GCIndex.is_index(index_dir):
+        return index_dir
+    os.makedirs(index_dir, exist_ok=True)
+
+    gc_table = np.zeros(256, dtype=np.uint16)
+    gc_table[np.frombuffer(b'GCgc', dtype=np.uint8)] = 1
+    acgt_table = np.zeros(256, dtype=np.uint16)
+    acgt_table[np.frombuffer(b'ACGTacgt', dtype=np.uint8)] = 1
+
+    if mappability_file is not None:
+        bw = pyBigWig.open(mappability_file)
+        bw_chroms = bw.chroms()
+
+    index = OrderedDict()
+    offset = 0
+
+    with open(os.path.join(index_dir, GCIndex.gc_file), 'wb') as gc_data,\
+    open(os.path.join(index_dir, GCIndex.acgt_file), 'wb') as acgt_data,\
+    open(os.path.join(index_dir, GCIndex.mappability_file), 'wb') as map_data:
+        for name, seq in _iter_sequences(fasta_file):
+            nb_bins = int(np.ceil(len(seq) / bin_size))
+            padded = np.zeros(nb_bins * bin_size, dtype=np.uint8)
+            padded[:len(seq)] = seq
+            padded = padded.reshape((nb_bins, bin_size))
+
+            gc_data.write(gc_table[padded].sum(axis=1, dtype=np.uint16).tobytes())
+            acgt_data.write(acgt_table[padded].sum(axis=1, dtype=np.uint16).tobytes())
+
+            if mappability_file is not None:
+                if name in bw_chroms and nb_bins > 0:
+                    stop = min(len(seq), bw_chroms[name])
+                    values = bw.stats(name, 0, stop,
+                                      nBins=int(np.ceil(stop / bin_size)),
+                                      type='mean')
+                    values = np.array([0. if value is None else value\
+                                       for value in values])
+                else:
+                    values = np.zeros(0)
+                mappability = np.zeros(nb_bins, dtype=np.uint8)
+                mappability[:len(values)] = np.round(np.clip(values, 0, 1) * 255)
+                map_data.write(mappability.tobytes())
+
+            index[name] = [offset, nb_bins]
+            offset += nb_bins
+
+    if mappability_file is not None:
+        bw.close()
+
+    # the index is written last so that an interrupted computation is not
+    # taken for an index.
+    with open(os.path.join(index_dir, GCIndex.index_file), 'w') as index_file:
+        json.dump({'bin_size' : bin_size,
+                   'mappability' : mappability_file is not None,
+                   'chroms' : index}, index_file)
+    return index_dir
+
+
+class GCIndex(object):
+    """
+    Reads an index written by compile_gc_index, the bins are memory mapped.
+    Returns the GC content and the mappability of windows at the resolution
+    of the bins.
+
+    args:
+        index_dir:
+            The directory written by compile_gc_index.
+    """
+    index_file = 'index.json'
+    gc_file = 'gc.u2'
+    acgt_file = 'acgt.u2'
+    mappability_file = 'mappability.u1'
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+
+        with open(os.path.join(index_dir, self.index_file), 'r') as index_file:
+            index = json.load(index_file)
+        self.bin_size = index['bin_size']
+        self.offsets = {name : offset for name, (offset, _) in index['chroms'].items()}
+        self.nb_bins = {name : nb_bins for name, (_, nb_bins) in index['chroms'].items()}
+
+        self.gc = np.memmap(os.path.join(index_dir, self.gc_file),
+                            dtype=np.uint16,
+                            mode='r')
+        self.acgt = np.memmap(os.path.join(index_dir, self.acgt_file),
+                              dtype=np.uint16,
+                              mode='r')
+        if index['mappability']:
+            self.mappability = np.memmap(os.path.join(index_dir,
+                                                      self.mappability_file),
+                                         dtype=np.uint8,
+                                         mode='r')
+        else:
+            self.mappability = None
+
+    @staticmethod
+    def is_index(path):
+        """Returns True if path is a directory written by compile_gc_index."""
+        return isinstance(path, str) and\
+        os.path.isfile(os.path.join(path, GCIndex.index_file))
+
+    def __getstate__(self):
+        return {'index_dir' : self.index_dir}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def window_stats(self, chroms, starts, stops, chunk_size=10 ** 7):
+        """
+        Returns the GC fraction of the windows (NaN if the windows only
+        contain N) and their mean mappability (None without mappability),
+        computed on the bins overlapping the windows.
+        """
+        chroms = np.asarray(chroms).astype(str)
+        starts = np.asarray(starts, dtype=np.int64)
+        stops = np.asarray(stops, dtype=np.int64)
+
+        chrom_names, chrom_idx = np.unique(chroms, return_inverse=True)
+        offsets = np.array([self.offsets[chrom] for chrom in chrom_names],
+                           dtype=np.int64)[chrom_idx]
+        nb_bins = np.array([self.nb_bins[chrom] for chrom in chrom_names],
+                           dtype=np.int64)[chrom_idx]
+
+        first_bins = np.clip(starts // self.bin_size, 0, nb_bins)
+        last_bins = np.clip(- (- stops // self.bin_size), 0, nb_bins)
+        width = max(int(np.max(last_bins - first_bins)), 1) if len(starts) else 1
+
+        gc = np.zeros(len(starts))
+        acgt = np.zeros(len(starts))
+        mappability = np.zeros(len(starts))
+
+        # the bins of the windows are gathered by chunks of windows
+        step = max(chunk_size // width, 1)
+        for chunk in range(0, len(starts), step):
+            sl = slice(chunk, chunk + step)
+            bins = first_bins[sl, np.newaxis] + np.arange(width)
+            valid = bins < last_bins[sl, np.newaxis]
+            positions = (offsets[sl, np.newaxis] + bins)[valid]
+            rows = np.where(valid)[0]
+
+            gc[sl] = np.bincount(rows, self.gc[positions], len(bins))
+            acgt[sl] = np.bincount(rows, self.acgt[positions], len(bins))
+            if self.mappability is not None:
+                mappability[sl] = np.bincount(rows,
+                                              self.mappability[positions],
+                                              len(bins)) /\
+                                  np.maximum(valid.sum(axis=1), 1) / 255.
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            gc = np.where(acgt > 0, gc / acgt, np.nan)
+
+        if self.mappability is None:
+            return gc, None
+        return gc, mappability
+
+
+def compile_n_index(fasta_file, index_file=None):
+    """
+    Scans once a genome and writes the runs of N of every chromosome as
+    sorted intervals in a npz file readable by NIndex. The index is not
+    computed again if the file already exists.
+
+    args:
+        fasta_file:
+            The fasta file (can be gzipped) or a genome directory written by
+            compile_genome.
+        index_file:
+            The file where to write the index, default is the fasta file name
+            with the extension .nruns.npz
+    returns:
+        The path to the index file.
+    """
+    if index_file is None:
+        index_file = fasta_file[:-3] if fasta_file.endswith('.gz') else fasta_file
+        index_file = os.path.splitext(index_file.rstrip('/'))[0] + '.nruns.npz'
+
+    if NIndex.is_index(index_file):
+        return index_file
+
+    n_table = np.zeros(256, dtype=np.int8)
+    n_table[np.frombuffer(b'Nn', dtype=np.uint8)] = 1
+
+    chroms, nb_runs, starts, stops = list(), list(), list(), list()
+
+    if fasta_file.endswith('.npz'):
+        raise ValueError('{} is not an index written by compile_n_index'\
+                         .format(fasta_file))
+
+    for name, seq in _iter_sequences(fasta_file):
+        # a run starts where the sequence enters N and stops where it leaves
+        edge = np.zeros(1, dtype=np.int8)
+        changes = np.diff(np.concatenate([edge, n_table[seq], edge]))
+        starts.append(np.where(changes == 1)[0])
+        stops.append(np.where(changes == -1)[0])
+        chroms.append(name)
+        nb_runs.append(len(starts[-1]))
+
+    if not chroms:
+        raise ValueError('No sequence was found in {}, a fasta file or an index '
+                         'written by compile_n_index is expected'.format(fasta_file))
+
+    # written in a temporary file first so that an interrupted computation
+    # is not taken for an index.
+    directory = os.path.dirname(os.path.abspath(index_file))
+    fd, tmp_file = tempfile.mkstemp(dir=directory, suffix='.npz')
+    with os.fdopen(fd, 'wb') as npz_file:
+        np.savez(npz_file,
+                 chroms=np.array(chroms, dtype=str),
+                 nb_runs=np.array(nb_runs, dtype=np.int64),
+                 starts=np.concatenate(starts + [np.zeros(0, dtype=np.int64)]),
+                 stops=np.concatenate(stops + [np.zeros(0, dtype=np.int64)]))
+    os.replace(tmp_file, index_file)
+    return index_file
+
+
+class NIndex(RegionIndex):
+    """
+    Reads the runs of N written by compile_n_index. Counts the N of windows by
+    binary search on the runs, and finds the windows with too many N
+    arithmetically, without reading the sequence.
+
+    args:
+        index_file:
+            The npz file written by compile_n_index.
+    """
+    def __init__(self, index_file):
+        self.index_file = index_file
+        self.regions = dict()
+
+        with np.load(index_file) as index:
+            limits = np.concatenate([[0], np.cumsum(index['nb_runs'])])
+            for i, chrom in enumerate(index['chroms']):
+                self.regions[self._key(chrom)] =\
+                (index['starts'][limits[i] : limits[i + 1]].astype(np.int64),
+                 index['stops'][limits[i] : limits[i + 1]].astype(np.int64))
+
+    keys = ('chroms', 'nb_runs', 'starts', 'stops')
+
+    @staticmethod
+    def is_index(path):
+        """
+        Returns True if path is a file written by compile_n_index, whatever
+        its name (the arrays of the npz file are checked).
+        """
+        if not isinstance(path, str) or not os.path.isfile(path):
+            return False
+        try:
+            with np.load(path) as index:
+                return set(NIndex.keys) <= set(index.files)
+        except Exception:
+            return False
+
+    def _n_before(self, chrom, positions):
+        """Returns the number of N before every position of a chromosome."""
+        positions = np.asarray(positions, dtype=np.int64)
+        starts, stops = self.get(chrom)
+
+        if len(starts) == 0:
+            return np.zeros(len(positions), dtype=np.int64)
+
+        lengths = stops - starts
+        cum_lengths = np.concatenate([[0], np.cumsum(lengths)])
+
+        # the last run starting before a position may contain it
+        last = np.maximum(np.searchsorted(starts, positions, side='right') - 1, 0)
+        inside = np.clip(positions - starts[last], 0, lengths[last])
+        return cum_lengths[last] + inside
+
+    def n_counts(self, chrom, starts, stops):
+        """Returns the number of N in the windows [starts, stops) of a chromosome."""
+        return self._n_before(chrom, stops) - self._n_before(chrom, starts)
+
+    def dense_windows(self, chrom, window, max_n_fraction):
+        """
+        Returns the centers, as merged intervals (starts, stops), of the
+        windows [center - window // 2, center - window // 2 + window) of a
+        chromosome with more than max_n_fraction N.
+
+        The number of N of a window is linear in its center between the
+        centers where one of its ends meets the limit of a run, the centers
+        above the threshold are found on every such segment.
+        """
+        run_starts, run_stops = self.get(chrom)
+        hw = window // 2
+        threshold = int(np.floor(max_n_fraction * window))
+
+        if len(run_starts) == 0:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty
+
+        limits = np.unique(np.concatenate([run_starts + hw,
+                                           run_stops + hw,
+                                           run_starts + hw - window,
+                                           run_stops + hw - window]))
+        counts = self.n_counts(chrom, limits - hw, limits - hw + window)
+
+        lows, highs = limits[:-1], limits[1:]
+        count_lows = counts[:-1]
+        slopes = (counts[1:] - count_lows) // (highs - lows)
+
+        starts = np.where(slopes > 0,
+                          np.maximum(lows, lows + threshold - count_lows + 1),
+                          lows)
+        stops = np.where(slopes < 0,
+                         np.minimum(highs, lows + count_lows - threshold),
+                         highs)
+        kept = (stops > starts) & ((slopes != 0) | (count_lows > threshold))
+
+        return merge_intervals(starts[kept], stops[kept])
+
+
+def load_n_index(path):
+    """
+    Returns the NIndex of a file written by compile_n_index, or of a fasta
+    file (the index is computed the first time).
+    """
+    if NIndex.is_index(path):
+        return NIndex(path)
+    return NIndex(compile_n_index(path))
+
+
+def _remove_cache_files(cache_files):
+    """Removes the coverage files written by the current process."""
+    for pid, path in list(cache_files):
+        if pid == os.getpid():
+            if os.path.exists(path):
+                os.remove(path)
+            cache_files.remove((pid, path))
+
+
+def is_remote(bbi_file):
+    """Whether a bigWig file is read through the network (a URL)."""
+    return bbi_file.startswith(('http://', 'https://', 'ftp://'))
+
+
+def zoom_levels(bbi_file):
+    """
+    Returns the list of the reduction levels (the number of bases summarized
+    by one zoom record) of a bigWig file, read from its header.
+    """
+    if is_remote(bbi_file):
+        ### The zoom headers follow the 64 bytes header, a bigWig file has at
+        ### most 10 zoom levels.
+        request = urllib.request.Request(bbi_file,
+                                         headers={'Range' : 'bytes=0-{}'.format(64 + 24 * 10 - 1)})
+        with urllib.request.urlopen(request) as bbi:
+            content = bbi.read(64 + 24 * 10)
+    else:
+        with open(bbi_file, 'rb') as bbi:
+            content = bbi.read(64 + 24 * 10)
+
+    header = content[:64]
+    byte_order = '<' if struct.unpack('<I', header[:4])[0] == 0x888FFC26 else '>'
+    nb_levels = struct.unpack(byte_order + 'H', header[6:8])[0]
+    zoom_headers = content[64 : 64 + 24 * nb_levels]
+
+    return [struct.unpack(byte_order + 'I', zoom_headers[24 * i : 24 * i + 4])[0]\
+            for i in range(nb_levels)]
+
+
 class bbi_extractor(object):
     """
     Reads the data into a bigWig file. Returns the coverage on an interval
@@ -40,6 +788,39 @@ class bbi_extractor(object):
             at the coverage.
         normalization_mode:
             argument from the Normalizer class
+        max_open_files:
+            The maximal number of bbi files kept open between two calls to
+            extract (see BigWigPool).
+            default=64
+        cache_coverage:
+            If True, the whole coverage of a chromosome is read, normalized
+            and stored the first time the chromosome is needed, the next
+            extractions are taken from this cache.
+            default=False
+        cache_memory:
+            The maximal number of bytes of coverage kept in memory, the next
+            chromosomes are written in cache_dir and memory mapped. None for
+            no limit.
+            default=None
+        cache_dir:
+            The directory where to write the chromosomes exceeding
+            cache_memory, default is the temporary directory of the system.
+            default=None
+        cache_dtype:
+            {'float32', 'float16'} the type of the cached coverage.
+            default='float32'
+        approximate_sampling:
+            If True and sampling_mode is 'mean' or 'downsampling', the value
+            of every bin is the mean given by the zoom levels of the bigWig
+            file (the base resolution coverage is not read). The mean is then
+            taken only on the covered bases and the normalization is applied
+            after averaging. Used only if the bins are larger than the finest
+            zoom level of every file and if every file is remote (an http,
+            https or ftp URL): it reduces the amount of data downloaded but
+            pyBigWig computes every bin separately, it is about 20 times
+            slower than the exact reading on local files, which are then
+            read at base resolution (with a warning).
+            default=False
         *args, **kwargs:
             other arguments from Normalizer class
     """
@@ -49,6 +830,12 @@ class bbi_extractor(object):
                  nb_annotation_type=None,
                  sampling_mode=None,
                  normalization_mode=None,
+                 max_open_files=64,
+                 cache_coverage=False,
+                 cache_memory=None,
+                 cache_dir=None,
+                 cache_dtype='float32',
+                 approximate_sampling=False,
                  *args,
                  **kwargs):
         if not isinstance(bbi_files, list):
@@ -60,6 +847,31 @@ class bbi_extractor(object):
         self.nb_annotation_type = nb_annotation_type
         self.sampling_mode = sampling_mode
         self.normalization_mode = normalization_mode
+        self.pool = BigWigPool(max_open_files)
+        self.approximate_sampling = approximate_sampling
+        self.use_zoom_levels = approximate_sampling and\
+                               all(is_remote(bbi_file) for bbi_file in self.bbi_files)
+        if self.approximate_sampling and not self.use_zoom_levels:
+            warnings.warn("""approximate_sampling is only used with remote bigWig
+                          files (URLs), the local files are read at base
+                          resolution""")
+        if self.use_zoom_levels:
+            self.min_zoom_level = max([min(zoom_levels(bbi_file) or [np.inf])\
+                                       for bbi_file in self.bbi_files])
+        self.cache_coverage = cache_coverage
+        self.cache_memory = cache_memory
+        self.cache_dir = cache_dir if cache_dir else tempfile.gettempdir()
+        self.cache_dtype = np.dtype(cache_dtype)
+        self.cache = dict()
+        self.cache_size = 0
+        self.cache_files = list()
+        # shared by the processes forked from this one
+        self.cache_id = uuid.uuid4().hex
+        self._init_locks()
+        # the files written by the process are removed when the extractor is
+        # garbage collected or at the exit of the interpreter.
+        self._finalizer = weakref.finalize(self, _remove_cache_files,
+                                           self.cache_files)
 
         #TODO create a bam, bedGraph, wig to bigWig converter
         self.norm_dico = dict()
@@ -93,27 +905,190 @@ class bbi_extractor(object):
                                number of files per annotation,
                                number of annotation)
         """
+        return self._extract(interval.chrom, interval.start, interval.stop)
+
+    def extract_intervals(self, intervals):
+        """
+        Extract the coverage of every interval of an IntervalBatch.
+
+        returns:
+            np.array of shape (batch,
+                               window,
+                               number of files per annotation,
+                               number of annotation)
+        """
+        return np.array([self._extract(chrom, start, stop) for chrom, start, stop\
+                         in zip(intervals.chrom, intervals.starts, intervals.stops)])
+
+    def extract_batch(self, intervals):
+        """
+        Extract the coverage of every interval of an IntervalBatch at once.
+        The intervals are sorted by chromosome and position and overlapping
+        intervals are read with a single call to the bbi files, the coverage
+        is written in place in a preallocated array.
+
+        returns:
+            np.array of type float32 and shape (batch,
+                                                window,
+                                                number of files per annotation,
+                                                number of annotation)
+        """
+        starts, stops = self._read_coordinates(intervals.starts,
+                                               intervals.stops)
+        lengths = stops - starts
+
+        if len(intervals) == 0 or np.any(lengths != lengths[0]):
+            return self.extract_intervals(intervals)
+
+        length = int(lengths[0])
+        nb_files = len(self.bbi_files)
+
+        if self.sampling_mode:
+            assert length % self.window == 0,\
+            """Window must divide the input length to use downsampling"""
+            sampling_length = length // self.window
+
+        if self._use_summaries(length):
+            return self._reshape(self._read_summaries(intervals, starts, stops))
+
+        if self.sampling_mode == 'downsampling':
+            # only one value every sampling_length is needed
+            reads = np.empty((len(intervals), self.window, nb_files), dtype=np.float32)
+            positions = np.arange(0, length, sampling_length)
+        else:
+            reads = np.empty((len(intervals), length, nb_files), dtype=np.float32)
+            positions = np.arange(length)
+
+        if self.cache_coverage and np.all(starts >= 0):
+            for chrom_code in np.unique(intervals.chroms):
+                rows = np.where(intervals.chroms == chrom_code)[0]
+                coverage = self._get_chromosome(str(intervals.chrom_names[chrom_code]))
+                reads[rows] = coverage[starts[rows, np.newaxis] + positions]
+        else:
+            self._read_batch(intervals, starts, stops, positions, reads)
+
+        if self.sampling_mode == 'mean':
+            seqs = np.mean(reads.reshape((len(intervals),
+                                          self.window,
+                                          sampling_length,
+                                          nb_files)),
+                           axis=2,
+                           dtype='float32')
+        elif self.sampling_mode in (None, 'downsampling'):
+            seqs = reads
+        else:
+            raise NameError('sampling_mode must be None, "mean" or "downsampling"')
+        return self._reshape(seqs)
+
+    def _read_coordinates(self, starts, stops):
+        """Returns the coordinates to be read for every interval."""
+        starts = np.asarray(starts, dtype=np.int64)
+        stops = np.asarray(stops, dtype=np.int64)
+
+        if not self.sampling_mode:
+            assert np.all(self.window <= np.abs(stops - starts)),\
+            """The target window must be smaller than the input length"""
+
+            centers = (starts + stops) // 2
+            starts = centers - self.window // 2
+            stops = centers + self.window // 2 + self.window % 2
+        return starts, stops
+
+    def _read_batch(self, intervals, starts, stops, positions, reads):
+        """
+        Reads the intervals sorted by chromosome and start, merging the
+        overlapping ones in one reading, and fills reads in place.
+        """
+        order = np.lexsort((starts, intervals.chroms))
+        chroms = intervals.chroms[order]
+        sorted_starts = starts[order]
+        sorted_stops = stops[order]
+
+        # a new reading begins when the chromosome changes or when the
+        # interval does not overlap the previous ones.
+        reach = np.maximum.accumulate(sorted_stops + chroms * (int(sorted_stops.max()) + 1))
+        new_read = np.ones(len(order), dtype=bool)
+        new_read[1:] = (chroms[1:] != chroms[:-1]) |\
+        (sorted_starts[1:] + chroms[1:] * (int(sorted_stops.max()) + 1) > reach[:-1])
+        bounds = np.append(np.where(new_read)[0], len(order))
+
+        for first, last in zip(bounds[:-1], bounds[1:]):
+            rows = order[first : last]
+            chrom = str(intervals.chrom_names[chroms[first]])
+            read_start = int(sorted_starts[first])
+            read_stop = int(sorted_stops[first : last].max())
+            offsets = (starts[rows] - read_start)[:, np.newaxis] + positions
+
+            for i, bbi_file in enumerate(self.bbi_files):
+                array = self.pool[bbi_file].values(chrom,
+                                                   read_start,
+                                                   read_stop,
+                                                   numpy=True)
+                array[np.isnan(array)] = 0
+                reads[rows, :, i] = self.norm_dico[bbi_file](array)[offsets]
+
+    def _use_summaries(self, length):
+        """Whether to read the zoom levels for an interval of this length."""
+        return bool(self.sampling_mode) and self.use_zoom_levels\
+        and not self.cache_coverage\
+        and length // self.window >= self.min_zoom_level
+
+    def _read_summaries(self, intervals, starts, stops):
+        """
+        Reads the mean coverage on window bins for every interval from the
+        zoom levels of the bigWig files, returns shape (batch, window, nb_files)
+        """
+        seqs = np.empty((len(intervals), self.window, len(self.bbi_files)),
+                        dtype=np.float32)
+
+        for row, (chrom, start, stop) in enumerate(zip(intervals.chrom,
+                                                       starts,
+                                                       stops)):
+            for i, bbi_file in enumerate(self.bbi_files):
+                seqs[row, :, i] = self._summary(bbi_file, chrom, start, stop)
+        return seqs
+
+    def _summary(self, bbi_file, chrom, start, stop):
+        array = np.array(self.pool[bbi_file].stats(str(chrom),
+                                                   int(start),
+                                                   int(stop),
+                                                   type='mean',
+                                                   nBins=self.window,
+                                                   exact=False),
+                         dtype=np.float64)
+        array[np.isnan(array)] = 0
+        return self.norm_dico[bbi_file](array)
+
+    def _extract(self, chrom, start, stop):
+        start, stop = int(start), int(stop)
+
         if not self.sampling_mode:
-            assert self.window <= abs(interval.stop - interval.start),\
+            assert self.window <= abs(stop - start),\
             """The target window must be smaller than the input length"""
 
-            interval = resize_interval(interval,
-                                       self.window,
-                                       anchor='center')
-        seq = list()
-        for bbi_file in self.bbi_files:
-            bw = pyBigWig.open(bbi_file)
-            array = bw.values(interval.chrom,
-                              interval.start,
-                              interval.stop, numpy=True)
-            array[np.isnan(array)] = 0
-            seq.append(self.norm_dico[bbi_file](array))
-        seq = np.array(seq).T
+            center = (start + stop) // 2
+            start = center - self.window // 2
+            stop = center + self.window // 2 + self.window % 2
+
+        if self._use_summaries(stop - start):
+            seq = np.array([self._summary(bbi_file, chrom, start, stop)\
+                            for bbi_file in self.bbi_files]).T
+            return self._reshape(seq)
+
+        if self.cache_coverage and start >= 0:
+            coverage = self._get_chromosome(chrom)
+
+            if stop <= len(coverage):
+                seq = coverage[start : stop]
+            else:
+                seq = self._read(chrom, start, stop)
+        else:
+            seq = self._read(chrom, start, stop)
 
         if self.sampling_mode:
-            assert abs(interval.stop - interval.start) % self.window == 0,\
+            assert abs(stop - start) % self.window == 0,\
             """Window must divide the input length to use downsampling"""
-            sampling_length = abs(interval.stop - interval.start) // self.window
+            sampling_length = abs(stop - start) // self.window
 
             if self.sampling_mode == 'downsampling':
                     seq = seq[::sampling_length]
@@ -122,15 +1097,139 @@ class bbi_extractor(object):
             else:
                 raise NameError('sampling_mode must be None, "mean" or "downsampling"')
         
+        return self._reshape(seq)
+
+    def _reshape(self, seq):
+        """
+        Reshapes a coverage of shape ([batch,] window, nb_files) into
+        ([batch,] window, number of files per annotation, number of annotation)
+        """
         if self.nb_annotation_type:
             nb_files_per_ann = len(self.bbi_files) // self.nb_annotation_type
-            return seq.reshape((self.window,
-                                nb_files_per_ann,
-                                self.nb_annotation_type))
-        
+            return seq.reshape(seq.shape[:-1] + (nb_files_per_ann,
+                                                 self.nb_annotation_type))
         else:
             return seq
 
+    def _read(self, chrom, start, stop):
+        """Reads and normalizes the coverage, returns shape (length, nb_files)"""
+        seq = list()
+        for bbi_file in self.bbi_files:
+            bw = self.pool[bbi_file]
+            array = bw.values(chrom, start, stop, numpy=True)
+            array[np.isnan(array)] = 0
+            seq.append(self.norm_dico[bbi_file](array))
+        return np.array(seq).T
+
+    def _init_locks(self):
+        self._pid = os.getpid()
+        # guards cache, cache_size and _chrom_locks
+        self._cache_lock = threading.Lock()
+        self._chrom_locks = dict()
+
+    def _get_chromosome(self, chrom):
+        """
+        Returns the normalized coverage of the whole chromosome, shape
+        (chromosome size, nb_files), reading it the first time. A chromosome
+        is read by a single thread, the others wait for it.
+        """
+        if self._pid != os.getpid():
+            # a lock may have been held by another thread during the fork
+            self._init_locks()
+
+        coverage = self.cache.get(chrom)
+        if coverage is not None:
+            return coverage
+
+        with self._cache_lock:
+            chrom_lock = self._chrom_locks.setdefault(chrom, threading.Lock())
+
+        with chrom_lock:
+            coverage = self.cache.get(chrom)
+            if coverage is None:
+                coverage = self._load_chromosome(chrom)
+                with self._cache_lock:
+                    self.cache[chrom] = coverage
+        return coverage
+
+    def _load_chromosome(self, chrom):
+        size = self.pool[self.bbi_files[0]].chroms(chrom)
+        nbytes = size * len(self.bbi_files) * self.cache_dtype.itemsize
+
+        with self._cache_lock:
+            in_memory = self.cache_memory is None or\
+            self.cache_size + nbytes <= self.cache_memory
+            if in_memory:
+                self.cache_size += nbytes
+
+        if in_memory:
+            coverage = np.empty((size, len(self.bbi_files)), dtype=self.cache_dtype)
+            for i in range(len(self.bbi_files)):
+                coverage[:, i] = self._read_file(i, chrom, size)
+            return coverage
+
+        path = os.path.join(self.cache_dir,
+                            'keras_dna_{}_{}.{}'.format(self.cache_id,
+                                                        chrom,
+                                                        self.cache_dtype.name))
+        if not os.path.exists(path):
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir,
+                                            prefix=os.path.basename(path),
+                                            suffix='.tmp')
+            os.close(fd)
+            try:
+                coverage = np.memmap(tmp_path,
+                                     dtype=self.cache_dtype,
+                                     mode='w+',
+                                     shape=(size, len(self.bbi_files)))
+                for i in range(len(self.bbi_files)):
+                    coverage[:, i] = self._read_file(i, chrom, size)
+                coverage.flush()
+                del coverage
+                # another process may have written the same file meanwhile
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+            self.cache_files.append((os.getpid(), path))
+
+        return np.memmap(path,
+                         dtype=self.cache_dtype,
+                         mode='r',
+                         shape=(size, len(self.bbi_files)))
+
+    def _read_file(self, file_idx, chrom, size):
+        bbi_file = self.bbi_files[file_idx]
+        array = self.pool[bbi_file].values(chrom, 0, size, numpy=True)
+        array[np.isnan(array)] = 0
+        return self.norm_dico[bbi_file](array)
+
+    def close(self):
+        """
+        Closes the bbi files kept open by the extractor and empties the cache
+        of coverage.
+        """
+        self.pool.close()
+        with self._cache_lock:
+            self.cache = dict()
+            self.cache_size = 0
+        _remove_cache_files(self.cache_files)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['cache'] = dict()
+        state['cache_size'] = 0
+        state['cache_files'] = list()
+        for name in ('_pid', '_cache_lock', '_chrom_locks', '_finalizer'):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_locks()
+        self._finalizer = weakref.finalize(self, _remove_cache_files,
+                                           self.cache_files)
+
     def _calculate_rolling_mean(self, x):
         sampling_length = len(x) // self.window
         num_classes = x.shape[1]
@@ -8,19 +8,475 @@ Created on Tue Jun 18 14:21:30 2019
 
 import numpy as np
 import inspect
+import pickle
+import queue
+import traceback
+import multiprocessing
+from multiprocessing import shared_memory
 from copy import deepcopy
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import tensorflow as tf
+from tensorflow.keras.utils import Sequence
 
 from .sequence import SeqIntervalDl, StringSeqIntervalDl
 from .normalization import Weights
 from .utils import ArgumentsDict, get_default_args
 
-class Generator(object):
+def _init_sequence(sequence, workers, use_multiprocessing, max_queue_size):
+    """
+    Calls the constructor of the keras Sequence, keras 3 (PyDataset) takes
+    the workers as arguments, tf.keras < 2.16 takes them in fit.
+    """
+    if 'workers' in inspect.signature(Sequence.__init__).parameters:
+        Sequence.__init__(sequence,
+                          workers=workers,
+                          use_multiprocessing=use_multiprocessing,
+                          max_queue_size=max_queue_size)
+    else:
+        Sequence.__init__(sequence)
+
+
+def _as_tf_dataset(generator):
+    """
+    Builds the tf.data pipeline of a Generator or a MultiGenerator, the
+    batch number i is generator[i] built in a tf.numpy_function. Every
+    iteration over the dataset is an epoch of the generator: the next
+    iterations start with generator.on_epoch_end, which reshuffles the
+    examples as the generator does and changes the epoch of the datasets
+    (resampled negatives). The batches of an iteration are all built (or
+    dropped) before the next one starts.
+    """
+    signature = _output_signature(generator)
+    flat_signature = tf.nest.flatten(signature)
+    nb_iterations = [0]
+
+    def get_batch(number):
+        batch = tf.nest.flatten(_as_tuple(generator[int(number)]))
+        return [_as_numpy(data, spec) for data, spec in zip(batch, flat_signature)]
+
+    def map_function(number):
+        batch = tf.numpy_function(get_batch,
+                                  [number],
+                                  [spec.dtype for spec in flat_signature])
+        for data, spec in zip(batch, flat_signature):
+            data.set_shape(spec.shape)
+        return tf.nest.pack_sequence_as(signature, batch)
+
+    def start_epoch():
+        if nb_iterations[0]:
+            generator.on_epoch_end()
+        nb_iterations[0] += 1
+        return np.int64(generator.epoch)
+
+    def batch_numbers(_):
+        return tf.data.Dataset.range(len(generator))
+
+    dataset = tf.data.Dataset.range(1).map(lambda _: tf.numpy_function(start_epoch,
+                                                                       [],
+                                                                       tf.int64))
+    dataset = dataset.flat_map(batch_numbers)
+    dataset = dataset.map(map_function, num_parallel_calls=tf.data.AUTOTUNE)
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def _output_signature(generator):
+    """
+    Returns the tf.TensorSpec structure of the batches, the shapes are
+    given by input_shape, secondary_input_shape and label_shape, the dtypes
+    are read on a batch of one example.
+    """
+    example = _as_tuple(generator._get_batch(generator.indexes[:1]))
+
+    if isinstance(example[0], tuple):
+        input_shapes = (generator.input_shape, generator.secondary_input_shape)
+    else:
+        input_shapes = generator.input_shape
+    if isinstance(example[1], tuple):
+        label_shapes = (generator.label_shape, generator.secondary_input_shape)
+    else:
+        label_shapes = generator.label_shape
+    shapes = (input_shapes, label_shapes)
+
+    if len(example) == 3:
+        # the weights have the shape of the labels without the last axes
+        shapes += (example[2].shape[1:],)
+
+    def spec(data, shape):
+        if isinstance(data, tuple):
+            return tuple(spec(data_, shape_) for data_, shape_ in zip(data, shape))
+        if data.dtype.kind in 'US':
+            return tf.TensorSpec((None,), tf.string)
+        return tf.TensorSpec((None,) + tuple(shape or data.shape[1:]),
+                             tf.as_dtype(data.dtype))
+
+    return spec(example, shapes)
+
+
+def _as_tuple(batch):
+    """Converts the lists of a batch into tuples (tf.nest structures)."""
+    if isinstance(batch, (list, tuple)):
+        return tuple(_as_tuple(data) for data in batch)
+    return np.asarray(batch)
+
+
+def _as_numpy(data, spec):
+    if spec.dtype == tf.string:
+        return np.char.encode(data.astype(str))
+    return np.asarray(data, dtype=spec.dtype.as_numpy_dtype)
+
+
+def _mix(values, key):
+    """Hashes the uint64 values with the key (splitmix64 finalizer)."""
+    values = values ^ key
+    values = (values ^ (values >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    values = (values ^ (values >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return values ^ (values >> np.uint64(31))
+
+
+class FeistelPermutation(object):
+    """
+    A random permutation of np.arange(length) computed on demand: a Feistel
+    network is a bijection on the integers of 2 * half_bits bits, the
+    values falling beyond length are permuted again until they fall inside
+    (cycle walking). Nothing of the size of length is stored.
+
+    args:
+        length:
+            The number of elements permuted.
+        seed:
+            The seed of the keys of the rounds of the network, drawn with
+            np.random if None.
+    """
+    def __init__(self, length, seed=None):
+        self.length = length
+        self.half_bits = max(1, (int(max(length - 1, 1)).bit_length() + 1) // 2)
+        if seed is None:
+            seed = np.random.randint(2 ** 32, dtype=np.int64)
+        self.keys = np.random.SeedSequence(int(seed)).generate_state(4, np.uint64)
+
+    def _network(self, values, inverse=False):
+        half_bits = np.uint64(self.half_bits)
+        mask = np.uint64((1 << self.half_bits) - 1)
+        left, right = values >> half_bits, values & mask
+
+        if inverse:
+            for key in self.keys[::-1]:
+                left, right = right ^ (_mix(left, key) & mask), left
+        else:
+            for key in self.keys:
+                left, right = right, left ^ (_mix(right, key) & mask)
+        return (left << half_bits) | right
+
+    def _walk(self, positions, inverse):
+        values = self._network(np.asarray(positions, dtype=np.uint64), inverse)
+        outside = np.where(values >= self.length)[0]
+        while len(outside):
+            values[outside] = self._network(values[outside], inverse)
+            outside = outside[values[outside] >= self.length]
+        return values.astype(np.int64)
+
+    def __call__(self, positions):
+        """Returns the elements at the positions of the permutation."""
+        return self._walk(positions, inverse=False)
+
+    def inverse(self, elements):
+        """Returns the positions of the elements in the permutation."""
+        return self._walk(elements, inverse=True)
+
+
+class ShuffledIndexes(object):
+    """
+    The order in which the examples of a Generator are read. The indexes of
+    a slice of positions are computed when the slice is asked, so that no
+    array of one index per example (every window of the genome for a
+    continuous dataset) is kept nor shuffled at every epoch.
+
+    args:
+        length:
+            The number of examples.
+        shuffle:
+            {True, False, 'block'}, with True the indexes follow a random
+            permutation (FeistelPermutation). With 'block' the indexes are
+            cut into blocks of block_size consecutive indexes, the order of
+            the blocks is shuffled and the indexes are shuffled inside every
+            group of shuffle_buffer consecutive blocks (as a shuffle buffer
+            would do). With False the indexes are in the order of the
+            dataset.
+        block_size:
+            The number of consecutive indexes in a block (shuffle='block').
+        shuffle_buffer:
+            The number of blocks whose indexes are shuffled together
+            (shuffle='block').
+        seed:
+            The seed of the first order, drawn with np.random if None.
+    """
+    def __init__(self, length, shuffle=True, block_size=256, shuffle_buffer=4,
+                 seed=None):
+        self.length = length
+        self.shuffle = shuffle
+        self.block_size = block_size
+        self.shuffle_buffer = shuffle_buffer
+        self.reshuffle(seed)
+
+    def reshuffle(self, seed=None):
+        """Draws a new order (with np.random if seed is None)."""
+        if seed is None:
+            seed = np.random.randint(2 ** 32, dtype=np.int64)
+
+        if self.shuffle == 'block':
+            nb_blocks = -(-self.length // self.block_size)
+            self._blocks = FeistelPermutation(nb_blocks, seed)
+            self._seed = seed
+            # the last block is shorter, the group it falls in too.
+            self._last_group = self._blocks.inverse([max(nb_blocks - 1, 0)])[0] //\
+                               self.shuffle_buffer if nb_blocks else 0
+        elif self.shuffle:
+            self._permutation = FeistelPermutation(self.length, seed)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            positions = np.arange(*key.indices(self.length))
+        else:
+            positions = np.asarray(key, dtype=np.int64)
+            if np.any((positions < -self.length) | (positions >= self.length)):
+                raise IndexError('index {} is out of range'.format(key))
+            positions = positions % self.length
+
+        if self.shuffle == 'block':
+            indexes = self._block_indexes(positions.ravel())
+        elif self.shuffle:
+            indexes = self._permutation(positions.ravel())
+        else:
+            indexes = positions.ravel()
+        return indexes.reshape(positions.shape)
+
+    def __array__(self, dtype=None):
+        return np.asarray(self[:], dtype=dtype)
+
+    def _block_indexes(self, positions):
+        group_size = self.block_size * self.shuffle_buffer
+        deficit = -self.length % self.block_size
+        # the positions after the short group are shifted by its deficit.
+        shifted = positions + deficit * (positions >= (self._last_group + 1) *\
+                                                      group_size - deficit)
+        groups = shifted // group_size
+
+        indexes = np.empty(len(positions), dtype=np.int64)
+        for group in np.unique(groups):
+            in_group = groups == group
+            indexes[in_group] = self._group_indexes(group)[shifted[in_group] -\
+                                                           group * group_size]
+        return indexes
+
+    def _group_indexes(self, group):
+        """Returns the shuffled indexes of the blocks of a group."""
+        first_block = group * self.shuffle_buffer
+        block_positions = np.arange(first_block,
+                                    min(first_block + self.shuffle_buffer,
+                                        self._blocks.length))
+        blocks = self._blocks(block_positions)
+
+        indexes = blocks[:, np.newaxis] * self.block_size + np.arange(self.block_size)
+        indexes = indexes.ravel()
+        indexes = indexes[indexes < self.length]
+
+        rng = np.random.default_rng(np.random.SeedSequence(int(self._seed),
+                                                           spawn_key=(int(group),)))
+        return indexes[rng.permutation(len(indexes))]
+
+
+def _flatten_batch(batch):
+    """Returns the list of the arrays of a batch (nested lists and tuples)."""
+    if isinstance(batch, (list, tuple)):
+        return [array for data in batch for array in _flatten_batch(data)]
+    return [np.asarray(batch)]
+
+
+def _pack_batch(structure, arrays):
+    """Rebuilds a batch with the structure of structure from a list of arrays."""
+    arrays = iter(arrays)
+
+    def pack(data):
+        if isinstance(data, (list, tuple)):
+            return type(data)(pack(data_) for data_ in data)
+        return next(arrays)
+
+    return pack(structure)
+
+
+def _shared_memory_worker(generator, buffers, tasks, results):
+    """
+    Builds the batches asked in tasks with generator._get_batch and writes
+    them into the slot of buffers given with the task.
+    """
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        number, slot, batch_indexes, epoch = task
+
+        try:
+            generator.dataset.set_epoch(epoch)
+            batch = _flatten_batch(generator._get_batch(batch_indexes))
+            for array, buffer in zip(batch, buffers[slot]):
+                buffer[:len(array)] = array
+            results.put((number, [len(array) for array in batch], None))
+        except Exception as error:
+            try:
+                pickle.dumps(error)
+            except Exception:
+                error = RuntimeError(traceback.format_exc())
+            results.put((number, None, error))
+
+
+class SharedMemoryTransport(object):
+    """
+    Builds the batches of a generator in worker processes and passes them
+    to the main process through a ring of buffers in shared memory instead
+    of pickling them. The batches are returned in the order of submission
+    as views on the shared memory, a view is valid until the next batch is
+    asked with get.
+
+    args:
+        generator:
+            A Generator or a PredictionGenerator, the batches are built with
+            its _get_batch method in forked processes.
+        example:
+            A batch of full size giving the structure, shapes and dtypes of
+            the batches.
+        workers:
+            The number of worker processes.
+        queue_size:
+            The maximal number of batches submitted and not yet taken.
+        timeout:
+            The interval in seconds at which get checks that the workers
+            are still alive while waiting for a batch.
+    """
+    def __init__(self, generator, example, workers, queue_size, timeout=1.):
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.structure = example
+        context = multiprocessing.get_context('fork')
+
+        self._memories = list()
+        self.buffers = list()
+        for _ in range(queue_size + 1):
+            slot_buffers = list()
+            for array in _flatten_batch(example):
+                memory = shared_memory.SharedMemory(create=True,
+                                                    size=max(array.nbytes, 1))
+                self._memories.append(memory)
+                slot_buffers.append(np.ndarray(array.shape,
+                                               dtype=array.dtype,
+                                               buffer=memory.buf))
+            self.buffers.append(slot_buffers)
+
+        self._free_slots = deque(range(queue_size + 1))
+        self._slots = dict()
+        self._ready = dict()
+        self._held_slot = None
+        self._next_submit = 0
+        self._next_get = 0
+
+        self._tasks = context.Queue()
+        self._results = context.Queue()
+        # the buffers are inherited by the forked workers.
+        self._workers = [context.Process(target=_shared_memory_worker,
+                                         args=(generator,
+                                               self.buffers,
+                                               self._tasks,
+                                               self._results),
+                                         daemon=True) for _ in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    @property
+    def pending(self):
+        """The number of batches submitted and not yet taken."""
+        return self._next_submit - self._next_get
+
+    def submit(self, batch_indexes, epoch=0):
+        """
+        Asks the workers to build the batch of the examples batch_indexes
+        during the epoch epoch (the workers do not see the epoch changing in
+        the main process).
+        """
+        assert self.pending < self.queue_size,\
+        """Too many batches submitted, get a batch first"""
+        slot = self._free_slots.popleft()
+        self._slots[self._next_submit] = slot
+        self._tasks.put((self._next_submit, slot, batch_indexes, epoch))
+        self._next_submit += 1
+
+    def get(self):
+        """
+        Returns the next batch in the order of submission, the buffer of the
+        previous batch is reused. Raises a RuntimeError if a worker died
+        (killed or crashed) while the batch was waited for.
+        """
+        if self._held_slot is not None:
+            self._free_slots.append(self._held_slot)
+            self._held_slot = None
+
+        while self._next_get not in self._ready:
+            try:
+                number, lengths, error = self._results.get(timeout=self.timeout)
+            except queue.Empty:
+                self._check_workers()
+                continue
+            self._ready[number] = (lengths, error)
+
+        lengths, error = self._ready.pop(self._next_get)
+        slot = self._slots.pop(self._next_get)
+        self._next_get += 1
+
+        if error is not None:
+            self._free_slots.append(slot)
+            raise error
+
+        self._held_slot = slot
+        arrays = [buffer[:length] for buffer, length in zip(self.buffers[slot],
+                                                             lengths)]
+        return _pack_batch(self.structure, arrays)
+
+    def _check_workers(self):
+        for worker in self._workers:
+            if not worker.is_alive():
+                raise RuntimeError('A shared memory worker died (exitcode {}) '
+                                   'before the batch {} was built'.format(worker.exitcode,
+                                                                          self._next_get))
+
+    def close(self):
+        """Stops the workers and releases the shared memory."""
+        for _ in self._workers:
+            self._tasks.put(None)
+        for worker in self._workers:
+            worker.join(timeout=1)
+            if worker.is_alive():
+                worker.terminate()
+        self._workers = list()
+        self.buffers = list()
+
+        for memory in self._memories:
+            memory.close()
+            memory.unlink()
+        self._memories = list()
+
+
+class Generator(Sequence):
     """
     info:
          doc: >
              Generator for keras model able to yield inputs and targets in batch
              by reading into a fasta file and a annotation file. Inputs are one-
-             hot-encoded or string.
+             hot-encoded or string. It is a keras Sequence: the batch number i
+             is returned by generator[i] and the examples are shuffled at the
+             end of every epoch, keras can then build batches in parallel.
      args:
          batch_size:
              number of example per batch pass to the model.
@@ -46,6 +502,45 @@ class Generator(object):
              the probability of classes. Can also be an array of bins or 'auto'
              for on optimized shearch of bins.
              default='auto'
+         workers:
+             number of workers used by keras to build batches in parallel when
+             the generator itself is passed to the model.
+             default=1
+         use_multiprocessing:
+             whether the workers are processes (forked, the files are reopened
+             in every process) or threads.
+             default=False
+         max_queue_size:
+             maximum number of batches waiting to be used by the model.
+             default=10
+         shuffle:
+             {True, False, 'block'} how the examples are shuffled at every
+             epoch. With 'block' the examples are cut into blocks of
+             block_size neighbouring examples, the blocks are shuffled and the
+             examples are then shuffled inside groups of shuffle_buffer blocks
+             so that a batch only reads a few regions of the genome.
+             default=True
+         block_size:
+             number of neighbouring examples in a block (shuffle='block').
+             default=256
+         shuffle_buffer:
+             number of blocks whose examples are shuffled together
+             (shuffle='block').
+             default=4
+         prefetch:
+             number of batches built in advance by a pool of threads in the
+             python generator returned by __call__ (0 to build the batches
+             when they are asked). The order of the batches is not changed.
+             default=0
+         num_threads:
+             number of threads building the prefetched batches.
+             default=1
+         transport:
+             {None, 'shared_memory'} with 'shared_memory' the python generator
+             returned by __call__ builds the batches in workers processes and
+             receives them through shared memory (max_queue_size batches in
+             advance), the batches yielded are views valid until the next one.
+             default=None
          args:
              arguments specific to the different dataloader that can be used.
          kwargs:
@@ -56,12 +551,31 @@ class Generator(object):
                        output_shape=None,
                        weighting_mode=None,
                        bins='auto',
+                       workers=1,
+                       use_multiprocessing=False,
+                       max_queue_size=10,
+                       shuffle=True,
+                       block_size=256,
+                       shuffle_buffer=4,
+                       prefetch=0,
+                       num_threads=1,
+                       transport=None,
                        *args,
                        **kwargs):
+        _init_sequence(self, workers, use_multiprocessing, max_queue_size)
         self.one_hot_encoding = one_hot_encoding
         self.output_shape = output_shape
         self.weighting_mode = weighting_mode
         self.bins = bins
+        self.workers = workers
+        self.use_multiprocessing = use_multiprocessing
+        self.max_queue_size = max_queue_size
+        self.shuffle = shuffle
+        self.block_size = block_size
+        self.shuffle_buffer = shuffle_buffer
+        self.prefetch = prefetch
+        self.num_threads = num_threads
+        self.transport = transport
         self.frame = inspect.currentframe()
 
         old_shape = StringSeqIntervalDl.predict_label_shape(**kwargs)
@@ -88,38 +602,108 @@ class Generator(object):
                                    self.weighting_mode,
                                    self.bins)
 
+        self.epoch = 0
+        self.indexes = ShuffledIndexes(len(self.dataset),
+                                       self.shuffle,
+                                       self.block_size,
+                                       self.shuffle_buffer)
+
+    def _shuffle_indexes(self):
+        self.indexes.reshuffle()
+
+    def __getitem__(self, index):
+        """Returns the batch number index (inputs, outputs[, weights])."""
+        return self._get_batch(self.indexes[index * self.batch_size :\
+                                            (index + 1) * self.batch_size])
+
+    def _get_batch(self, batch_indexes):
+        data = self.dataset[list(batch_indexes)]
+        inputs = data['inputs']
+        outputs = data['targets']
+
+        if self.output_shape:
+            if isinstance(outputs, np.ndarray):
+                outputs = outputs.reshape((outputs.shape[0],) +\
+                                          tuple(self.output_shape)[1:])
+            else:
+                outputs[0] = outputs[0].reshape((outputs[0].shape[0],) +\
+                                                tuple(self.output_shape)[1:])
+        if self.weighting_mode:
+            weights = self.weights.find_weights(outputs)
+            return inputs, outputs, weights
+        return inputs, outputs
+
+    def on_epoch_end(self):
+        """Reshuffles the train set after an epoch."""
+        self.epoch += 1
+        self.dataset.set_epoch(self.epoch)
+        self._shuffle_indexes()
+
+    def as_tf_dataset(self):
+        """
+        Returns a tf.data.Dataset yielding the batches generator[i], every
+        iteration over it is an epoch (the examples are shuffled as the
+        generator shuffles them). The batches are built in parallel by a map
+        with AUTOTUNE and prefetched.
+        """
+        return _as_tf_dataset(self)
+
     def __call__(self):
         """Returns a generator to train a keras model (yielding inputs and
         outputs)."""
-        def generator_function(dataset, batch_size):
-            indexes = np.arange(0, len(dataset), 1)
-            number_of_batches = len(dataset) // batch_size
-            
+        def generator_function():
             while True:
-            # reshuffled the train set after an epoch
-                np.random.shuffle(indexes)
-                
-                for num in range(number_of_batches):
-                    batch_indexes = indexes[num*batch_size : (num + 1) * batch_size]
-                    data = dataset[list(batch_indexes)]
-                    inputs = data['inputs']
-                    outputs = data['targets']
-                    
-                    if self.output_shape:
-                        if isinstance(outputs, np.ndarray):
-                            outputs = outputs.reshape((outputs.shape[0],) +\
-                                                      tuple(self.output_shape)[1:])
-                        else:
-                            outputs[0] = outputs.reshape((outputs[0].shape[0],) +\
-                                                          tuple(self.output_shape)[1:])
-                    if self.weighting_mode:
-                        weights = self.weights.find_weights(outputs)
-                        
-                        yield inputs, outputs, weights
-                    else:
-                        yield inputs, outputs
-            
-        return generator_function(self.dataset, self.batch_size)
+                for num in range(len(self)):
+                    yield self[num]
+                self.on_epoch_end()
+
+        def prefetch_function():
+            executor = ThreadPoolExecutor(max_workers=self.num_threads)
+            futures = deque()
+
+            try:
+                while True:
+                    for num in range(len(self)):
+                        batch_indexes = self.indexes[num * self.batch_size :\
+                                                     (num + 1) * self.batch_size]
+                        futures.append(executor.submit(self._get_batch,
+                                                       batch_indexes))
+
+                        if len(futures) > self.prefetch:
+                            yield futures.popleft().result()
+                    # the batches of the epoch are built before on_epoch_end
+                    # changes the epoch of the dataset (resampled negatives).
+                    while futures:
+                        yield futures.popleft().result()
+                    self.on_epoch_end()
+            finally:
+                for future in futures:
+                    future.cancel()
+                executor.shutdown(wait=False)
+
+        def shared_memory_function():
+            example = self._get_batch(self.indexes[:self.batch_size])
+            transport = SharedMemoryTransport(self,
+                                              example,
+                                              self.workers,
+                                              self.max_queue_size)
+            try:
+                while True:
+                    for num in range(len(self)):
+                        if transport.pending == transport.queue_size:
+                            yield transport.get()
+                        transport.submit(self.indexes[num * self.batch_size :\
+                                                      (num + 1) * self.batch_size],
+                                         self.epoch)
+                    self.on_epoch_end()
+            finally:
+                transport.close()
+
+        if self.transport == 'shared_memory':
+            return shared_memory_function()
+        if self.prefetch:
+            return prefetch_function()
+        return generator_function()
 
     def __len__(self):
         return len(self.dataset) // self.batch_size
@@ -190,13 +774,15 @@ class Generator(object):
             return None
 
 
-class MultiGenerator(object):
+class MultiGenerator(Sequence):
     """
     info:
         doc: >
             Class able to yield inputs and targets from several different
             interval readers. Usefull to train on several species or to train
-            on both direct and reverse side.
+            on both direct and reverse side. It is a keras Sequence, the
+            examples are shuffled at the end of every epoch (ShuffledIndexes
+            over the examples of all the datasets).
      args:
          batch_size:
              number of example per batch pass to the model.
@@ -210,45 +796,84 @@ class MultiGenerator(object):
              How to modify the shape of the output (because the initial output
              structure is (batch, length, nb_types, nb_annotation) or (batch,
              nb_types, nb_annotation))
+         workers:
+             number of workers used by keras to build batches in parallel.
+             default=1
+         use_multiprocessing:
+             whether the workers are processes or threads.
+             default=False
+         max_queue_size:
+             maximum number of batches waiting to be used by the model.
+             default=10
     """
     def __init__(self, batch_size,
                        dataset_list,
                        inst_per_dataset='all',
-                       output_shape=None):
+                       output_shape=None,
+                       workers=1,
+                       use_multiprocessing=False,
+                       max_queue_size=10):
+        _init_sequence(self, workers, use_multiprocessing, max_queue_size)
         self.dataset_list = dataset_list
         self.batch_size = batch_size
         self.inst_per_dataset = inst_per_dataset
         self.output_shape = output_shape
+        self.workers = workers
+        self.use_multiprocessing = use_multiprocessing
+        self.max_queue_size = max_queue_size
         self.frame = inspect.currentframe()
         self._verify_dataset_list()
 
+        self.epoch = 0
+        self._init_indexes()
+        self.indexes = ShuffledIndexes(int(self._offsets[-1]))
+
+    def __getitem__(self, index):
+        """Returns the batch number index (inputs, outputs)."""
+        return self._get_batch(self.indexes[index * self.batch_size :\
+                                            (index + 1) * self.batch_size])
+
+    def _get_batch(self, positions):
+        inputs = None
+        targets = None
+        batch_indexes = self._get_indexes(positions)
+
+        for dataset_index, dataset in enumerate(self.dataset_list):
+            sub_batch_indexes = batch_indexes[batch_indexes[:, 0] == dataset_index]
+            data = dataset[sub_batch_indexes[:, 1].tolist()]
+            inputs = self._append_data(inputs, data['inputs'])
+            targets = self._append_data(targets, data['targets'])
+        if self.output_shape:
+            targets = targets.reshape((targets.shape[0],) +\
+                                       tuple(self.output_shape)[1:])
+        return inputs, targets
+
+    def on_epoch_end(self):
+        """Reshuffles the train set after an epoch."""
+        self.epoch += 1
+        for dataset in self.dataset_list:
+            dataset.set_epoch(self.epoch)
+        self.indexes.reshuffle()
+
+    def as_tf_dataset(self):
+        """
+        Returns a tf.data.Dataset yielding the batches generator[i], every
+        iteration over it is an epoch (the examples are shuffled as the
+        generator shuffles them). The batches are built in parallel by a map
+        with AUTOTUNE and prefetched.
+        """
+        return _as_tf_dataset(self)
+
     def __call__(self):
         """Returns a generator to train a keras model (yielding inputs and
         outputs)."""
-        indexes = self._get_indexes()
-        def generator_function(list_of_dataset, batch_size):
-            number_of_batches = len(indexes) // batch_size
-            
+        def generator_function():
             while True:
-            # reshuffled the train set after an epoch
-                np.random.shuffle(indexes)
-            
-                for num in range(number_of_batches):
-                    batch_indexes = indexes[num*batch_size : (num + 1) * batch_size]
-                    inputs = None
-                    targets = None
-
-                    for dataset_index, dataset in enumerate(list_of_dataset): 
-                        sub_batch_indexes = batch_indexes[batch_indexes[:, 0] == dataset_index]
-                        data = dataset[sub_batch_indexes[:, 1].tolist()]
-                        inputs = self._append_data(inputs, data['inputs'])
-                        targets = self._append_data(targets, data['targets'])
-                    if self.output_shape:
-                        targets = targets.reshape((targets.shape[0],) +\
-                                                   tuple(self.output_shape)[1:])
-                    yield inputs, targets
-            
-        return generator_function(self.dataset_list, self.batch_size)
+                for num in range(len(self)):
+                    yield self[num]
+                self.on_epoch_end()
+
+        return generator_function()
 
     def _append_data(self, ldata, rdata):
         if isinstance(ldata, list):
@@ -268,34 +893,46 @@ class MultiGenerator(object):
                     ldata = rdata
         return ldata
 
-    def _get_indexes(self):
+    def _init_indexes(self):
+        """
+        The examples of the datasets are numbered one after the other, the
+        examples taken from a dataset with fewer instances than its length
+        are the first elements of a random permutation of its indexes.
+        """
         if not self.inst_per_dataset == 'all':
             assert len(self.dataset_list) == len(self.inst_per_dataset),\
             """To pass the number of examples to be taken from every dataset,
             the list of dataset and list of number must be of the same length
             """
 
-        indexes = np.zeros((1, 2))
         if self.inst_per_dataset == 'all':
             self.inst_per_dataset = [len(dataset) for dataset in self.dataset_list]
-        
-        for dataset_index, dataset in enumerate(self.dataset_list):
-            length = len(dataset)
-            nb_inst = self.inst_per_dataset[dataset_index]
-            indexes_ = np.append(np.repeat([[dataset_index]], nb_inst,
-                                           axis=0),
-                                 np.random.choice(np.arange(length),
-                                                  nb_inst,
-                                                  replace=False).reshape(nb_inst,
-                                                                         1),
-                                 axis=1)
-
-            indexes = np.append(indexes, indexes_, axis=0)
-        indexes = indexes[1:].astype(int)
-        return indexes
+
+        self._subsets = list()
+        for dataset, nb_inst in zip(self.dataset_list, self.inst_per_dataset):
+            assert nb_inst <= len(dataset),\
+            """Cannot take {} examples from a dataset of length {}""".format(nb_inst,
+                                                                           len(dataset))
+            if nb_inst < len(dataset):
+                self._subsets.append(FeistelPermutation(len(dataset)))
+            else:
+                self._subsets.append(None)
+        self._offsets = np.cumsum([0] + list(self.inst_per_dataset))
+
+    def _get_indexes(self, positions):
+        """Returns the rows [dataset index, index in the dataset] of positions."""
+        positions = np.asarray(positions, dtype=np.int64)
+        dataset_indexes = np.searchsorted(self._offsets, positions, side='right') - 1
+        indexes = positions - self._offsets[dataset_indexes]
+
+        for dataset_index, subset in enumerate(self._subsets):
+            in_dataset = dataset_indexes == dataset_index
+            if subset is not None and np.any(in_dataset):
+                indexes[in_dataset] = subset(indexes[in_dataset])
+        return np.stack([dataset_indexes, indexes], axis=1)
 
     def __len__(self):
-        return len(self._get_indexes()) // self.batch_size
+        return len(self.indexes) // self.batch_size
 
     @property
     def command_dict(self):
@@ -354,13 +991,14 @@ class MultiGenerator(object):
             return self.dataset_list[0].label_shape 
 
 
-class PredictionGenerator(object):
+class PredictionGenerator(Sequence):
     """
     info:
         doc: >
             Takes the command dict of a Generator instance (or a SeqIntervalDl
             or a StringSeqIntervalDl instance) and returns a generator needed
-            to predict all along chromosomes.
+            to predict all along chromosomes. It is a keras Sequence, the
+            batches are returned in the order of the chromosomes.
     
     args:
         batch_size:
@@ -381,6 +1019,20 @@ class PredictionGenerator(object):
         rc:
             Weither or not to predict with reverse complemented DNA sequences.
             default=False
+        workers:
+            number of workers used by keras to build batches in parallel.
+            default=1
+        use_multiprocessing:
+            whether the workers are processes or threads.
+            default=False
+        max_queue_size:
+            maximum number of batches waiting to be used by the model.
+            default=10
+        transport:
+            {None, 'shared_memory'} build the batches of the python generator
+            returned by __call__ in worker processes and receive them through
+            shared memory (see Generator).
+            default=None
     """
     def __init__(self,
                  batch_size,
@@ -389,12 +1041,21 @@ class PredictionGenerator(object):
                  incl_chromosomes,
                  start_stop=None,
                  fasta_file=None,
-                 rc=False):
+                 rc=False,
+                 workers=1,
+                 use_multiprocessing=False,
+                 max_queue_size=10,
+                 transport=None):
+        _init_sequence(self, workers, use_multiprocessing, max_queue_size)
         self.batch_size = batch_size
         self.command_dict = command_dict
         self.chrom_size = chrom_size
         self.start_stop = start_stop
         self.rc = rc
+        self.workers = workers
+        self.use_multiprocessing = use_multiprocessing
+        self.max_queue_size = max_queue_size
+        self.transport = transport
 
         if isinstance(incl_chromosomes, list):
             self.incl_chromosomes = incl_chromosomes
@@ -447,23 +1108,45 @@ class PredictionGenerator(object):
     def __len__(self):
         return len(self.dataset) // self.batch_size + 1
 
+    def __getitem__(self, index):
+        """Returns the inputs of the batch number index as a tuple (inputs,)."""
+        return self._get_batch(self._batch_indexes(index))
+
+    def _batch_indexes(self, index):
+        return np.arange(index * self.batch_size,
+                         min((index + 1) * self.batch_size,
+                             len(self.dataset)))
+
+    def _get_batch(self, batch_indexes):
+        return (self.dataset[list(batch_indexes)]['inputs'],)
+
     def __call__(self):
         """Returns a generator to train a keras model (yielding inputs and
         outputs)."""
-        def generator_function(dataset, batch_size):
-            indexes = np.arange(len(dataset))
-            number_of_batches = len(dataset) // batch_size + 1
-
+        def generator_function():
             while True:
-                for num in range(number_of_batches):
-                    if num == number_of_batches - 1:
-                        batch_indexes = indexes[num * batch_size :]
-                    else:
-                        batch_indexes = indexes[num*batch_size : (num + 1) * batch_size]
-                    data = dataset[list(batch_indexes)]
-                    yield data['inputs']
-
-        return generator_function(self.dataset, self.batch_size)
+                for num in range(len(self)):
+                    yield self[num][0]
+
+        def shared_memory_function():
+            example = self._get_batch(np.arange(min(self.batch_size,
+                                                    len(self.dataset))))
+            transport = SharedMemoryTransport(self,
+                                              example,
+                                              self.workers,
+                                              self.max_queue_size)
+            try:
+                while True:
+                    for num in range(len(self)):
+                        if transport.pending == transport.queue_size:
+                            yield transport.get()[0]
+                        transport.submit(self._batch_indexes(num))
+            finally:
+                transport.close()
+
+        if self.transport == 'shared_memory':
+            return shared_memory_function()
+        return generator_function()
 
     @property
     def index_df(self):
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 10:12:45 2026
+
+@author: routhier
+"""
+
+import numpy as np
+import pybedtools
+
+from .utils import bed_to_df
+
+
+class IntervalBatch(object):
+    """
+    Batch of genomic intervals stored as numpy arrays. Chromosomes are stored
+    as integer codes referring to a table of names. The batch can be indexed
+    and iterated as a list of pybedtools.Interval, the conversion being done
+    only when an interval is accessed.
+
+    args:
+        chrom_names:
+            The names of the chromosomes, chroms refers to this table.
+        chroms:
+            Array of integer codes of the chromosome of every interval.
+        starts:
+            Array of the starts of the intervals.
+        stops:
+            Array of the stops of the intervals.
+        strands:
+            Array of the strands ('+', '-' or '.') or None if the intervals
+            are not stranded.
+            default=None
+    """
+    def __init__(self,
+                 chrom_names,
+                 chroms,
+                 starts,
+                 stops,
+                 strands=None):
+        self.chrom_names = np.asarray(chrom_names)
+        self.chroms = np.asarray(chroms, dtype=np.int64)
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.stops = np.asarray(stops, dtype=np.int64)
+
+        if strands is None:
+            self.strands = None
+        else:
+            self.strands = np.asarray(strands)
+
+    @classmethod
+    def from_intervals(cls, intervals):
+        """Creates a batch from a list of pybedtools.Interval."""
+        chrom_names, chroms = np.unique([interval.chrom for interval in intervals],
+                                        return_inverse=True)
+        return cls(chrom_names,
+                   chroms,
+                   [interval.start for interval in intervals],
+                   [interval.stop for interval in intervals],
+                   [interval.strand for interval in intervals])
+
+    @property
+    def chrom(self):
+        """The name of the chromosome of every interval."""
+        return self.chrom_names[self.chroms]
+
+    @property
+    def lengths(self):
+        return self.stops - self.starts
+
+    @property
+    def stranded(self):
+        return self.strands is not None
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            return self._to_interval(idx)
+
+        return IntervalBatch(self.chrom_names,
+                             self.chroms[idx],
+                             self.starts[idx],
+                             self.stops[idx],
+                             None if self.strands is None else self.strands[idx])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._to_interval(i)
+
+    def _to_interval(self, i):
+        fields = [str(self.chrom_names[self.chroms[i]]),
+                  int(self.starts[i]),
+                  int(self.stops[i])]
+
+        if self.strands is not None:
+            fields += ['.', '.', str(self.strands[i])]
+        return pybedtools.create_interval_from_list(fields)
+
+    def to_intervals(self):
+        """Returns the batch as a list of pybedtools.Interval."""
+        return list(self)
+
+
+def overlap_join(starts, stops, ref_starts, ref_stops):
+    """
+    Finds all the pairs of overlapping intervals between a set of intervals
+    and a set of reference intervals taken on the same chromosome. The
+    references are sorted by start, the candidates of an interval are found
+    by binary search (the references starting before its stop and after its
+    start minus the length of the longest reference), the memory used is
+    linear in the number of candidates.
+
+    returns:
+        (idx, ref_idx, overlap_starts, overlap_stops) the index of the
+        interval and of the reference of every overlapping pair, and the
+        limits of their overlap.
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    stops = np.asarray(stops, dtype=np.int64)
+    ref_starts = np.asarray(ref_starts, dtype=np.int64)
+    ref_stops = np.asarray(ref_stops, dtype=np.int64)
+
+    if len(ref_starts) == 0 or len(starts) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty, empty
+
+    order = np.argsort(ref_starts, kind='stable')
+    sorted_starts = ref_starts[order]
+    max_length = np.max(ref_stops - ref_starts)
+
+    first = np.searchsorted(sorted_starts, starts - max_length, side='right')
+    last = np.searchsorted(sorted_starts, stops, side='left')
+    counts = np.maximum(last - first, 0)
+
+    idx = np.repeat(np.arange(len(starts)), counts)
+    shifts = np.repeat(first - (np.cumsum(counts) - counts), counts)
+    ref_idx = order[np.arange(np.sum(counts)) + shifts]
+
+    overlap = ref_stops[ref_idx] > starts[idx]
+    idx, ref_idx = idx[overlap], ref_idx[overlap]
+
+    return idx,\
+           ref_idx,\
+           np.maximum(starts[idx], ref_starts[ref_idx]),\
+           np.minimum(stops[idx], ref_stops[ref_idx])
+
+
+def merge_intervals(starts, stops):
+    """
+    Returns the union of intervals of a chromosome as sorted, non overlapping
+    intervals (starts, stops).
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    stops = np.asarray(stops, dtype=np.int64)
+
+    if len(starts) == 0:
+        return starts, stops
+
+    order = np.argsort(starts, kind='stable')
+    starts = starts[order]
+    stops = np.maximum.accumulate(stops[order])
+
+    # a new interval begins where the start is after all the previous stops
+    new = np.append(True, starts[1:] > stops[:-1])
+    return starts[new], stops[np.append(np.where(new)[0][1:] - 1, len(stops) - 1)]
+
+
+def subtract_intervals(starts, stops, ex_starts, ex_stops):
+    """
+    Removes merged intervals (see merge_intervals) from intervals of the same
+    chromosome.
+
+    returns:
+        (idx, piece_starts, piece_stops) the pieces left and the index of the
+        interval they come from.
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    stops = np.asarray(stops, dtype=np.int64)
+    idx, ex_idx, _, _ = overlap_join(starts, stops, ex_starts, ex_stops)
+
+    # an interval cut by k excluded intervals gives k + 1 pieces, starting at
+    # its start or at an excluded stop and ending at an excluded start or at
+    # its stop.
+    piece_idx = np.concatenate([np.arange(len(starts)), idx])
+    piece_starts = np.concatenate([starts, np.asarray(ex_stops)[ex_idx]])
+    piece_stops = np.concatenate([np.asarray(ex_starts)[ex_idx], stops])
+    stop_idx = np.concatenate([idx, np.arange(len(starts))])
+
+    start_order = np.lexsort((piece_starts, piece_idx))
+    stop_order = np.lexsort((piece_stops, stop_idx))
+    piece_idx = piece_idx[start_order]
+    piece_starts = piece_starts[start_order]
+    piece_stops = piece_stops[stop_order]
+
+    kept = piece_stops > piece_starts
+    return piece_idx[kept], piece_starts[kept], piece_stops[kept]
+
+
+class RegionIndex(object):
+    """
+    Regions of the genome read from a bed file (for example a blacklist or
+    the gaps of an assembly), merged and sorted by chromosome. The names of
+    the chromosomes are compared without the 'chr' prefix.
+
+    args:
+        bed_file:
+            The bed file with the regions (can be gzipped).
+    """
+    def __init__(self, bed_file):
+        self.bed_file = bed_file
+        df = bed_to_df(bed_file, ['region'])
+        self.regions = dict()
+
+        for chrom, df_ in df.groupby('chrom'):
+            self.regions[self._key(chrom)] = merge_intervals(df_.start.values,
+                                                             df_.stop.values)
+
+    @staticmethod
+    def _key(chrom):
+        chrom = str(chrom)
+        return chrom[3:] if chrom.startswith('chr') else chrom
+
+    def get(self, chrom):
+        """Returns the sorted regions (starts, stops) of a chromosome."""
+        empty = np.zeros(0, dtype=np.int64)
+        return self.regions.get(self._key(chrom), (empty, empty))
@@ -7,6 +7,7 @@ Created on Wed Dec  4 14:35:42 2019
 """
 
 import json
+import inspect
 from copy import deepcopy
 import pyBigWig
 import numpy as np
@@ -113,24 +114,41 @@ class ModelWrapper(object):
               **kwargs):
         if not steps_per_epoch:
             steps_per_epoch = len(self.generator_train)
-            
-        if hasattr(self, 'generator_val'):
-            if not validation_steps:
-                validation_steps = len(self.generator_val)
-            
-            history = self.model.fit_generator(generator = self.generator_train(),
-                                               steps_per_epoch = steps_per_epoch, 
-                                               epochs = epochs,
-                                               validation_data = self.generator_val(), 
-                                               validation_steps = validation_steps, 
-                                               *args,
-                                               **kwargs)
+
+        if getattr(self.generator_train, 'prefetch', 0) or\
+           getattr(self.generator_train, 'transport', None):
+            # the python generator builds the batches in its own threads or
+            # worker processes, keras only iterates over it.
+            train_data = self.generator_train()
+            fit_kwargs = kwargs
         else:
-            history = self.model.fit_generator(generator = self.generator_train(),
-                                               steps_per_epoch = steps_per_epoch, 
-                                               epochs = epochs,
-                                               *args,
-                                               **kwargs)
+            train_data = self.generator_train
+            fit_kwargs = _sequence_kwargs(self.model.fit,
+                                          self.generator_train,
+                                          kwargs)
+
+        try:
+            if hasattr(self, 'generator_val'):
+                if not validation_steps:
+                    validation_steps = len(self.generator_val)
+            
+                history = self.model.fit(train_data,
+                                         steps_per_epoch = steps_per_epoch, 
+                                         epochs = epochs,
+                                         validation_data = self.generator_val, 
+                                         validation_steps = validation_steps, 
+                                         *args,
+                                         **fit_kwargs)
+            else:
+                history = self.model.fit(train_data,
+                                         steps_per_epoch = steps_per_epoch, 
+                                         epochs = epochs,
+                                         *args,
+                                         **fit_kwargs)
+        finally:
+            if train_data is not self.generator_train:
+                # stops the threads or the workers and frees the shared memory
+                train_data.close()
         return history
 
     def _update_hdf5(self, h5dict, arguments, dataset):
@@ -189,10 +207,12 @@ class ModelWrapper(object):
 
             generator_eval = Generator(**command_dict)
 
-        evaluations = self.model.evaluate_generator(generator=generator_eval(),
-                                                    steps=len(generator_eval),
-                                                    *args,
-                                                    **kwargs)
+        evaluations = self.model.evaluate(generator_eval,
+                                          steps=len(generator_eval),
+                                          *args,
+                                          **_sequence_kwargs(self.model.evaluate,
+                                                             generator_eval,
+                                                             kwargs))
         return evaluations
 
     def get_auc(self,
@@ -297,10 +317,12 @@ class ModelWrapper(object):
                 eval_list.append({'cell_idx' : cell_idx,
                                   'annotation' : ann,
                                   'AU' + curve :\
-                                  model.evaluate_generator(generator=generator_eval(),
-                                                           steps=len(generator_eval),
-                                                           *args,
-                                                           **kwargs)[1]})
+                                  model.evaluate(generator_eval,
+                                                 steps=len(generator_eval),
+                                                 *args,
+                                                 **_sequence_kwargs(model.evaluate,
+                                                                    generator_eval,
+                                                                    kwargs))[1]})
         return eval_list
 
     def get_correlation(self,
@@ -405,10 +427,12 @@ class ModelWrapper(object):
         model.compile(optimizer=self.model.optimizer,
                       loss=self.model.loss,
                       metrics=metrics)
-        evaluations = model.evaluate_generator(generator=generator_eval(),
-                                               steps=len(generator_eval),
-                                               *args,
-                                               **kwargs)
+        evaluations = model.evaluate(generator_eval,
+                                     steps=len(generator_eval),
+                                     *args,
+                                     **_sequence_kwargs(model.evaluate,
+                                                        generator_eval,
+                                                        kwargs))
         
         return {'correlate_{}_{}'.format(int(idx / nb_annotation),\
                 idx % nb_annotation) : evaluations[idx + 1] for idx in indexes}
@@ -467,10 +491,12 @@ class ModelWrapper(object):
                                                   fasta_file,
                                                   rc)
 
-        prediction = self.model.predict_generator(generator=self.pred_generator(),
-                                                  steps=len(self.pred_generator),
-                                                  *args,
-                                                  **kwargs)
+        prediction = self.model.predict(self.pred_generator,
+                                        steps=len(self.pred_generator),
+                                        *args,
+                                        **_sequence_kwargs(self.model.predict,
+                                                           self.pred_generator,
+                                                           kwargs))
 
         if export_to_path:
             self._multi_export_to_bigwig(export_to_path,
@@ -631,6 +657,21 @@ class ModelWrapper(object):
         bw_file.close()
 
 
+def _sequence_kwargs(method, generator, kwargs):
+    """
+    Returns the keyword arguments of fit, evaluate or predict for a keras
+    Sequence: the workers are taken from the generator when the method takes
+    them (tf.keras < 2.16), keras 3 reads them on the Sequence.
+    """
+    sequence_kwargs = dict()
+    if 'workers' in inspect.signature(method).parameters:
+        sequence_kwargs = {'workers' : generator.workers,
+                           'use_multiprocessing' : generator.use_multiprocessing,
+                           'max_queue_size' : generator.max_queue_size}
+    sequence_kwargs.update(kwargs)
+    return sequence_kwargs
+
+
 def load_wrapper(path,
                  *args,
                  **kwargs):
@@ -173,8 +173,10 @@ class Weights(object):
                 df = dataset.seq_dl.dataset.df
 
             if weighting_mode == 'balanced':
-                nb_neg = len(df[df.type ==  0])
-                nb_pos = len(df[df.type != 0])
+                # a row of the dataframe can hold several windows
+                nb_windows = df.last_index.values - df.first_index.values + 1
+                nb_neg = np.sum(nb_windows[df.type.values == 0])
+                nb_pos = np.sum(nb_windows[df.type.values != 0])
                 
                 self.value_positive = (nb_neg + nb_pos) / float(nb_pos * 2)
                 self.value_negative = (nb_neg + nb_pos) / float(nb_neg * 2)
@@ -6,24 +6,33 @@ Created on Mon Jun 17 10:17:41 2019
 @author: routhier
 """
 
+import os
+import json
+import hashlib
+import tempfile
 import pandas as pd
 import numpy as np
-import pybedtools
-import random
 import warnings
 import pyBigWig
 import inspect
 import sys
 
 
-from kipoiseq.extractors import FastaStringExtractor
+from kipoiseq import Interval
 from kipoiseq.transforms import ReorderedOneHot
 from kipoiseq.transforms.functional import fixed_len
-from kipoiseq.utils import DNA
+from kipoiseq.utils import DNA, parse_alphabet, parse_dtype
 
 
 from . import utils
-from .extractors import bbi_extractor
+from .extractors import bbi_extractor, get_fasta_extractor, GenomeArray
+from .extractors import GCIndex, compile_gc_index, load_n_index
+from .intervals import IntervalBatch, RegionIndex, overlap_join,\
+                       merge_intervals, subtract_intervals
+
+
+SPARSE_EXTENSIONS = ('.bed', '.gff', 'gff3', 'gtf',
+                     '.bed.gz', '.gff.gz', 'gff3.gz', 'gtf.gz')
 
 
 class SparseDataset(object):
@@ -33,7 +42,8 @@ class SparseDataset(object):
             Reads the positions corresponding to some annotations in a file
             dedicated to store sparse annotation (gff, gtf, bed) and return a
             pybedtool interval corresponding to every annitation as long as a
-            label for every interval.
+            label for every interval. The labels are not stored, they are
+            computed from the annotations for the windows of a batch.
     args:
         annotation_files:
             list of file with annotations (one file per cellular type for
@@ -52,6 +62,7 @@ class SparseDataset(object):
         data_augmentation:
             boolean, if true return all the window of the given length where an
             annotation fit entirely in (false = one window per annotation),
+            the windows and their labels are computed when they are asked.
             default=False
         seq2seq:
             boolean, if true the label will be of the length of the input
@@ -82,7 +93,52 @@ class SparseDataset(object):
             function will return only positive example, 'random' will return 
             interval of length 0.
             default='real'
+        negative_matching:
+            {None, 'gc'} with 'gc' the real negative windows are drawn so that
+            their GC content (and mappability if the index has it) follows
+            the distribution of the positive windows.
+            default=None
+        gc_index:
+            The GC index used to match the negative windows: a directory
+            written by extractors.compile_gc_index, or a fasta file whose
+            index is computed once (bins of 100 bases) and kept next to it.
+            default=None
+        resample_negatives:
+            If True, the negative windows are drawn again in the gaps between
+            the positive windows every time a batch is asked, instead of once
+            when the dataset is created (negative_type='real' and an integer
+            negative_ratio only).
+            default=False
+        exclude_regions:
+            A bed file with regions to exclude (for example a blacklist), no
+            negative window overlapping one of them is taken.
+            default=None
+        max_n_fraction:
+            If not None, the windows (positive and negative) with a larger
+            fraction of N are removed from the dataset, an n_index is needed.
+            default=None
+        n_index:
+            The runs of N of the genome: a file written by
+            extractors.compile_n_index, or a fasta file whose index is
+            computed once and kept next to it.
+            default=None
+        seed:
+            The seed of the negative windows drawn (and of their strands),
+            drawn with np.random if None. With a seed the dataset and the
+            resampled negatives of every batch and epoch are reproducible.
+            default=None
+        cache_dir:
+            A directory where the dataset is cached once built. The cached
+            dataset is found by a checksum of the annotation files and of the
+            arguments, so that it is built again if one of them changes.
+            default=None
     """
+    # changed when the content of the cached datasets changes
+    cache_version = 1
+    # number of classes of GC content and mappability for negative_matching
+    gc_strata = 20
+    mappability_strata = 5
+
     def __init__(self, annotation_files,
                        annotation_list,
                        predict='all',
@@ -95,7 +151,15 @@ class SparseDataset(object):
                        excl_chromosomes=None,
                        ignore_targets=False,
                        negative_ratio=1,
-                       negative_type='real'):
+                       negative_type='real',
+                       negative_matching=None,
+                       gc_index=None,
+                       resample_negatives=False,
+                       exclude_regions=None,
+                       max_n_fraction=None,
+                       n_index=None,
+                       seed=None,
+                       cache_dir=None):
         self.annotation_files = annotation_files
         self.annotation_list = annotation_list
         self.predict = predict
@@ -109,22 +173,68 @@ class SparseDataset(object):
         self.ignore_targets = ignore_targets
         self.negative_ratio = negative_ratio
         self.negative_type = negative_type
+        self.negative_matching = negative_matching
+        self.gc_index = gc_index
+        self.resample_negatives = resample_negatives
+        self.exclude_regions = exclude_regions
+        self.max_n_fraction = max_n_fraction
+        self.n_index = n_index
+        self.cache_dir = cache_dir
+        # the negative windows drawn depend on them (see _batch_rng)
+        if seed is None:
+            seed = np.random.randint(2 ** 32, dtype=np.int64)
+        self.seed = seed
+        self.epoch = 0
         self.frame = inspect.currentframe()
 
         assert not (self.seq_len == 'real' and self.data_augmentation), \
         '''Returning the real position of the annotation is not compatible with
         data_augmentation'''
 
+        assert not self.resample_negatives or\
+        (self.negative_type == 'real' and isinstance(self.negative_ratio, int)),\
+        '''To resample the negative examples negative_type must be 'real' and
+        negative_ratio an integer'''
+
+        assert self.negative_matching in (None, 'gc'),\
+        '''negative_matching should be None or "gc"'''
+
+        assert self.negative_matching is None or\
+        (self.gc_index is not None and isinstance(self.negative_ratio, int)\
+         and not self.resample_negatives),\
+        '''To match the negative examples a gc_index must be passed and
+        negative_ratio must be an integer (without resample_negatives)'''
+
+        assert self.max_n_fraction is None or self.n_index is not None,\
+        '''To filter the windows on their N content an n_index must be passed'''
+
         if not isinstance(self.annotation_files, list):
             self.annotation_files = [self.annotation_files]
 
+        if self.seq2seq:
+            self.defined_positive = 'match_any'
+
+        if self.cache_dir is None:
+            self._build()
+        else:
+            cache_file = self._cache_file()
+
+            if os.path.exists(cache_file):
+                self._load(cache_file)
+            else:
+                self._build()
+                self._save(cache_file)
+
+    def _build(self):
+        """Reads the annotation files and builds the windows of the dataset."""
         df_ann_list = list()
 
         for annotation_file in self.annotation_files:
-            if annotation_file.endswith('.bed'):
+            if annotation_file.endswith(('.bed', '.bed.gz')):
                 df_ann_list.append(utils.bed_to_df(annotation_file,
                                                    self.annotation_list))
-            if annotation_file.endswith(('.gff', 'gff3', 'gtf')):
+            if annotation_file.endswith(('.gff', 'gff3', 'gtf',
+                                         '.gff.gz', 'gff3.gz', 'gtf.gz')):
                 df_ann_list.append(utils.gff_to_df(annotation_file,
                                                    self.annotation_list))
 
@@ -137,10 +247,10 @@ class SparseDataset(object):
             self.ann_df['chrom'] = "chr" + self.ann_df['chrom']
         
         # omit data outside chromosomes
-        if incl_chromosomes is not None:
-            self.ann_df = self.ann_df[self.ann_df.chrom.isin(incl_chromosomes)]
-        if excl_chromosomes is not None:
-            self.ann_df = self.ann_df[~self.ann_df.chrom.isin(excl_chromosomes)]
+        if self.incl_chromosomes is not None:
+            self.ann_df = self.ann_df[self.ann_df.chrom.isin(self.incl_chromosomes)]
+        if self.excl_chromosomes is not None:
+            self.ann_df = self.ann_df[~self.ann_df.chrom.isin(self.excl_chromosomes)]
         
         if not self.predict == 'all':
             self._restrict()
@@ -152,25 +262,101 @@ class SparseDataset(object):
         else:
             raise NameError('seq_len should be "MAXLEN", "real" or an integer')
 
-        if self.seq2seq:
-            self.defined_positive = 'match_any'
-
         self.df = self._get_dataframe()
+        if self.max_n_fraction is not None:
+            self._drop_n_windows()
+        self.nb_types = len(self.ann_df.type.unique())
+        self.nb_labels = len(self.ann_df.label.unique())
 
         if not self.ignore_targets:
-            self.labels = self._get_labels()
+            # the labels are computed batch by batch from the annotations
+            self._get_inter_annotations()
 
         if self.negative_type == 'random':
             assert isinstance(self.negative_ratio, int), \
             'To use random negative sequence negative_ratio must be an integer'
             self._random_negative_class()
 
+        elif self.negative_type == 'real' and self.negative_matching:
+            self.df = self.df.append(self._matched_negative_class())
+
+        elif self.negative_type == 'real' and self.resample_negatives:
+            self.df = self.df.append(self._resampled_negative_class())
+
         elif self.negative_type == 'real':
-            neg_df, neg_label = self._negative_class()
-            self.df = self.df.append(neg_df)
+            self.df = self.df.append(self._negative_class())
+        self._index_windows()
+
+    def _cache_file(self):
+        """
+        Returns the file caching the dataset, named after a checksum of the
+        content of the annotation files and of the arguments.
+        """
+        args = {name : getattr(self, name) for name in self.default_dict()\
+                if name != 'cache_dir'}
+        args['annotation_list'] = self.annotation_list
+        args['annotation_files'] = [utils.file_checksum(annotation_file)\
+                                    for annotation_file in self.annotation_files]
+        # the files are identified by their content, not by their path
+        for name in ('exclude_regions', 'gc_index', 'n_index'):
+            if getattr(self, name) is not None:
+                args[name] = utils.file_checksum(getattr(self, name))
+        args['version'] = self.cache_version
+
+        key = hashlib.sha256(json.dumps(args,
+                                        sort_keys=True,
+                                        default=str).encode()).hexdigest()
+        return os.path.join(self.cache_dir, 'sparse_dataset_{}.npz'.format(key))
+
+    def _save(self, cache_file):
+        """Writes the annotations, the windows and their indexes in a npz."""
+        arrays = {'length' : np.asarray(self.length),
+                  'nb_types' : np.asarray(self.nb_types),
+                  'nb_labels' : np.asarray(self.nb_labels)}
+
+        for name in ('ann_df', 'df'):
+            df = getattr(self, name).infer_objects()
+            for column in df.columns:
+                values = df[column].values
+                if values.dtype == object:
+                    values = values.astype(str)
+                arrays[name + '/' + column] = values
+
+        if not self.ignore_targets:
+            arrays['inter'] = self.inter
+
+        if self.resample_negatives:
+            arrays['gaps/chrom'] = self.gap_chroms
+            arrays['gaps/start'] = self.gap_starts
+            arrays['gaps/length'] = self.gap_lengths
+
+        # written in a temporary file first so that an interrupted writing
+        # is not taken for a cached dataset.
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fd, tmp_file = tempfile.mkstemp(dir=self.cache_dir, suffix='.npz')
+        with os.fdopen(fd, 'wb') as npz_file:
+            np.savez(npz_file, **arrays)
+        os.replace(tmp_file, cache_file)
+
+    def _load(self, cache_file):
+        """Reads a dataset written by _save."""
+        with np.load(cache_file) as cache:
+            self.length = cache['length'].item()
+            self.nb_types = cache['nb_types'].item()
+            self.nb_labels = cache['nb_labels'].item()
+
+            for name in ('ann_df', 'df'):
+                columns = [key for key in cache.files if key.startswith(name + '/')]
+                setattr(self, name, pd.DataFrame({column.split('/', 1)[1] : cache[column]\
+                                                  for column in columns}))
 
             if not self.ignore_targets:
-                self.labels = np.append(self.labels, neg_label, axis=0)
+                self._get_inter_annotations(cache['inter'])
+
+            if self.resample_negatives:
+                self.gap_chroms = cache['gaps/chrom']
+                self.gap_starts = cache['gaps/start']
+                self.gap_lengths = cache['gaps/length']
 
     @classmethod
     def default_dict(cls):
@@ -212,52 +398,86 @@ class SparseDataset(object):
         return self.predict_label_shape(**command_dict)
 
     def __getitem__(self, idx):
-        """Returns (pybedtools.Interval, labels)"""
+        """Returns (IntervalBatch, labels)"""
         if not isinstance(idx, list):
             idx = [idx]
-        row = self.df.iloc[idx]
-        
-        if self.ignore_targets:
-            labels = {}
-        else:
-            labels = self.labels[idx]
-            index = []
+        idx = np.asarray(idx, dtype=np.int64)
+
+        # the row of every window is found by a binary search on last_index,
+        # the windows of a row are shifted by one base from each other.
+        rows = np.searchsorted(self.df.last_index.values, idx)
+        offsets = idx - self.df.first_index.values[rows]
+        starts = self.df.start.values[rows].astype(np.int64) + offsets
+        stops = self.df.stop.values[rows].astype(np.int64) + offsets
+
+        chrom_values = np.asarray(self.df.chrom.values[rows], dtype=object)
 
-        intervals = list()
-        
         if 'strand' in self.df.columns:
-            for i in range(len(idx)):
-                row_ = row.iloc[i]
-                try:
-                    intervals.append(pybedtools.create_interval_from_list([row_.chrom,
-                                                                           int(row_.start),
-                                                                           int(row_.stop),
-                                                                           '.', '.',
-                                                                           row_.strand]))
-                    if not self.ignore_targets:
-                        index.append(i)
-
-                except OverflowError:
-                    warnings.warn("""Some of the input sequence were out of range
-                                  and have been removed""")
+            strands = self.df.strand.values[rows].astype(str)
+        else:
+            strands = None
+
+        if self.resample_negatives and len(idx):
+            # the windows of the last row are drawn again for every batch
+            rng = self._batch_rng(idx)
+            drawn = np.where(rows == len(self.df) - 1)[0]
+            chrom_values[drawn], starts[drawn] = self._draw_negatives(len(drawn),
+                                                                      rng)
+            stops[drawn] = starts[drawn] + self.length
+
+            if strands is not None:
+                strands[drawn] = rng.choice(['+', '-'], len(drawn))
+
+        in_range = (starts >= 0) & (stops >= 0)
+        if not np.all(in_range):
+            warnings.warn("""Some of the input sequence were out of range
+                          and have been removed""")
+            idx, rows = idx[in_range], rows[in_range]
+            starts, stops = starts[in_range], stops[in_range]
+            chrom_values = chrom_values[in_range]
+
+            if strands is not None:
+                strands = strands[in_range]
 
+        chrom_names, chroms = np.unique(chrom_values.astype(str),
+                                        return_inverse=True)
+
+        intervals = IntervalBatch(chrom_names, chroms, starts, stops, strands)
+
+        if self.ignore_targets:
+            labels = {}
         else:
-            for i in range(len(idx)):
-                row_ = row.iloc[i]
-                try:
-                    intervals.append(pybedtools.create_interval_from_list([row_.chrom,
-                                                                           int(row_.start),
-                                                                           int(row_.stop)]))
-                    if not self.ignore_targets:
-                        index.append(i)
-
-                except OverflowError:
-                    warnings.warn("""Some of the input sequence were out of range
-                                  and have been removed""")
-        return intervals, labels[index]
+            labels = self._get_window_labels(self.df.ann_index.values[rows],
+                                             starts,
+                                             stops)
+        return intervals, labels
 
     def __len__(self):
-        return len(self.df)
+        if len(self.df) == 0:
+            return 0
+        return int(self.df.last_index.values[-1]) + 1
+
+    def _index_windows(self):
+        """
+        Numbers the windows, the windows of the row i of df are the indexes
+        from first_index to last_index. A row holds nb_windows windows (one
+        without data_augmentation), the first one being at start, stop.
+        """
+        if 'nb_windows' in self.df.columns:
+            nb_windows = self.df.nb_windows.fillna(1).values.astype(np.int64)
+        else:
+            nb_windows = np.ones(len(self.df), dtype=np.int64)
+        self.df['ann_index'] = self.df.ann_index.fillna(-1).values.astype(np.int64)
+
+        self.df['last_index'] = np.cumsum(nb_windows) - 1
+        self.df['first_index'] = self.df.last_index.values - nb_windows + 1
+
+    def _zero_labels(self, length):
+        if self.seq2seq:
+            return np.zeros((length, self.length, self.nb_types, self.nb_labels),
+                            dtype=np.float32)
+        return np.zeros((length, self.nb_types, self.nb_labels),
+                        dtype=np.float32)
 
     def _multi_cellular_type(self, list_df):
         multi_df = pd.DataFrame()
@@ -317,7 +537,6 @@ class SparseDataset(object):
 
     def _calculate_interval(self,
                             df,
-                            return_all=False,
                             return_strand=False):
         if return_strand:
             assert 'strand' in df.columns, \
@@ -326,34 +545,7 @@ class SparseDataset(object):
         start = df.start.values
         stop = df.stop.values
 
-        if self.data_augmentation and return_all:
-            starts = np.concatenate([np.arange(stop[i] - self.length,
-                                               start[i] + 1)\
-                                     if start[i] - stop[i] + self.length >= 0\
-                                     else np.arange(start[i], stop[i] - self.length)\
-                                     for i in range(len(start))],
-                                     axis=0)
-            stops = np.concatenate([np.arange(stop[i],
-                                              start[i] + 1 + self.length)\
-                                    if start[i] - stop[i] + self.length >= 0\
-                                    else np.arange(start[i] + self.length, stop[i])\
-                                    for i in range(len(start))],
-                                    axis=0)
-
-            if return_strand:
-                strand = df.strand.values
-                strands = np.concatenate([np.repeat(strand[i],
-                                                    start[i] - stop[i] + self.length + 1)\
-                                          if stop[i] - start[i] <= self.length
-                                          else np.repeat(strand[i],
-                                                         stop[i] - start[i] - self.length)
-                                          for i in range(len(strand))\
-                                           ])
-                return starts, stops, strands
-            else:
-                return starts, stops
-
-        elif self.data_augmentation and not return_all:
+        if self.data_augmentation:
             starts = stop - self.length
             stops = start + self.length
 
@@ -371,6 +563,55 @@ class SparseDataset(object):
             else:
                 return start - half_wx - wx % 2, stop + half_wx
 
+    def _window_ranges(self, df):
+        """
+        Returns the start of the first window and the number of windows of
+        every annotation with data_augmentation: all the windows of length
+        where the annotation fits entirely in or, for an annotation longer
+        than length, all the windows within the annotation.
+        """
+        start = df.start.values
+        stop = df.stop.values
+        fit = stop - start <= self.length
+
+        first_starts = np.where(fit, stop - self.length, start)
+        nb_windows = np.where(fit,
+                              start - stop + self.length + 1,
+                              stop - start - self.length)
+        return first_starts, nb_windows
+
+    def _drop_n_windows(self):
+        """
+        Removes the positive windows with more than max_n_fraction N, counted
+        on the runs of N of n_index. With data_augmentation the windows of a
+        row are split around the starts of the windows to remove.
+        """
+        n_index = load_n_index(self.n_index)
+        new_df = pd.DataFrame()
+
+        for chrom in self.df.chrom.unique():
+            df_ = self.df[self.df.chrom == chrom]
+            starts = df_.start.values.astype(np.int64)
+            stops = df_.stop.values.astype(np.int64)
+
+            if self.data_augmentation:
+                dense_starts, dense_stops = n_index.dense_windows(chrom,
+                                                                  self.length,
+                                                                  self.max_n_fraction)
+                idx, piece_starts, piece_stops =\
+                subtract_intervals(starts,
+                                   starts + df_.nb_windows.values,
+                                   dense_starts - self.length // 2,
+                                   dense_stops - self.length // 2)
+                df_ = df_.iloc[idx].assign(start=piece_starts,
+                                           stop=piece_starts + self.length,
+                                           nb_windows=piece_stops - piece_starts)
+            else:
+                n_counts = n_index.n_counts(chrom, starts, stops)
+                df_ = df_[n_counts <= self.max_n_fraction * (stops - starts)]
+            new_df = new_df.append(df_)
+        self.df = new_df
+
     def _random_negative_class(self):
         chrom = self.df.chrom.unique()[0]
         number_neg = self.negative_ratio * len(self.df)
@@ -381,154 +622,316 @@ class SparseDataset(object):
         neg_df['chrom'] = chrom
         
         if 'strand' in self.ann_df.columns:
-            neg_df['strand'] = np.random.choice(['+', '-'], number_neg)
+            neg_df['strand'] = self._build_rng().choice(['+', '-'], number_neg)
             
         self.df = self.df.append(neg_df)
 
-        if not self.ignore_targets:
-            neg_shape = list(self.labels.shape)
-            neg_shape[0] = number_neg
-            neg_label = np.zeros(tuple(neg_shape))
-
-            self.labels = np.append(self.labels,
-                                    neg_label,
-                                    axis=0)
+    def _negative_gaps(self):
+        """
+        Yields for every chromosome the gaps between its positive windows: a
+        window starting in [gap_start, gap_start + gap_length) does not overlap
+        any positive window. The number of positive windows of the chromosome
+        is also given. The windows overlapping an excluded region or with
+        more than max_n_fraction N are removed from the gaps.
+        """
+        if self.exclude_regions is not None:
+            regions = RegionIndex(self.exclude_regions)
+        if self.max_n_fraction is not None:
+            n_index = load_n_index(self.n_index)
 
-    def _negative_class(self):
-        neg_df = pd.DataFrame()
-    
         for chrom in self.ann_df.chrom.unique():
             df_ = self.ann_df[self.ann_df.chrom == chrom]
-            df_ = df_.sort_values('start')
             pos_starts, pos_stops = self._calculate_interval(df_)
-            number_of_pos = np.sum(pos_stops - pos_starts)
 
-            pos_starts = pos_starts - self.length
-            list_interval = np.where((pos_starts[1:] - pos_stops[:-1]) > 0)[0]
+            order = np.argsort(pos_starts, kind='stable')
+            pos_starts = pos_starts[order]
+            pos_stops = np.maximum.accumulate(pos_stops[order])
+
+            gap_starts = pos_stops[:-1]
+            gap_lengths = pos_starts[1:] - self.length - gap_starts
+
+            ex_starts = [np.zeros(0, dtype=np.int64)]
+            ex_stops = [np.zeros(0, dtype=np.int64)]
+
+            if self.exclude_regions is not None:
+                # a window starting in [a - length + 1, b) overlaps [a, b)
+                region_starts, region_stops = regions.get(chrom)
+                ex_starts.append(region_starts - self.length + 1)
+                ex_stops.append(region_stops)
+
+            if self.max_n_fraction is not None:
+                dense_starts, dense_stops = n_index.dense_windows(chrom,
+                                                                  self.length,
+                                                                  self.max_n_fraction)
+                ex_starts.append(dense_starts - self.length // 2)
+                ex_stops.append(dense_stops - self.length // 2)
+
+            if len(ex_starts) > 1:
+                ex_starts, ex_stops = merge_intervals(np.concatenate(ex_starts),
+                                                      np.concatenate(ex_stops))
+                _, gap_starts, gap_stops =\
+                subtract_intervals(gap_starts[gap_lengths > 0],
+                                   (gap_starts + gap_lengths)[gap_lengths > 0],
+                                   ex_starts,
+                                   ex_stops)
+                gap_lengths = gap_stops - gap_starts
+
+            if self.data_augmentation:
+                number_of_pos = np.sum(self._window_ranges(df_)[1])
+            else:
+                number_of_pos = len(df_)
+
+            yield chrom,\
+                  gap_starts[gap_lengths > 0],\
+                  gap_lengths[gap_lengths > 0],\
+                  number_of_pos
 
+    def _negative_class(self):
+        """
+        Returns the negative windows, taken in the gaps between the positive
+        windows of every chromosome. With negative_ratio='all' a gap is one
+        row holding all its windows (see _index_windows), otherwise the
+        windows are drawn uniformly among all the windows of the gaps.
+        """
+        chroms, neg_starts, neg_windows = list(), list(), list()
+        rng = self._build_rng()
+
+        for chrom, gap_starts, gap_lengths, number_of_pos in self._negative_gaps():
             if self.negative_ratio == 'all':
-                neg_starts = np.concatenate([np.arange(pos_stops[interval_idx],
-                                                       pos_starts[interval_idx + 1])\
-                                             for interval_idx in list_interval],
-                                            0)
+                starts = gap_starts
+                nb_windows = gap_lengths
 
             elif isinstance(self.negative_ratio, int):
-                length_inters = np.array([pos_starts[i + 1] - pos_stops[i] for i in list_interval])
-                proba = length_inters / np.sum(length_inters)
-
-                if self.data_augmentation:
-                    number_of_pos *= self.negative_ratio
-                else:
-                    number_of_pos = len(self.ann_df[self.ann_df.chrom == chrom])
-                    number_of_pos *= self.negative_ratio
-
-                interval_chosen = np.random.choice(list_interval,
-                                                   number_of_pos,
-                                                   p=proba)
-
-                nb_per_interval = [min((interval_chosen == inter).sum(), length_inter)\
-                                   for inter, length_inter in zip(list_interval, length_inters)]
-
-                neg_starts = np.concatenate([np.random.choice(np.arange(pos_stops[interval_idx],
-                                                                        pos_starts[interval_idx + 1]),
-                                                              nb_inter,
-                                                              replace=False) for interval_idx,\
-                                                                                 nb_inter in\
-                                                                                 zip(list_interval,
-                                                                                     nb_per_interval)],
-                                            0)
+                gap_ends = np.cumsum(gap_lengths)
+                offsets = self._sample_offsets(int(np.sum(gap_lengths)),
+                                               number_of_pos * self.negative_ratio,
+                                               rng)
+                gap_idx = np.searchsorted(gap_ends, offsets, side='right')
+
+                starts = gap_starts[gap_idx] + offsets - (gap_ends - gap_lengths)[gap_idx]
+                nb_windows = np.ones(len(starts), dtype=np.int64)
             else:
                 raise NameError('negative_ratio should be "all" or an integer')
 
-            neg_df_ = pd.DataFrame()
-            neg_df_['start'] = neg_starts
-            neg_df_['stop'] = neg_starts + self.length
-            neg_df_['chrom'] = chrom
-
-            neg_df = neg_df.append(neg_df_)
+            chroms.append(np.repeat(chrom, len(starts)))
+            neg_starts.append(starts)
+            neg_windows.append(nb_windows)
 
+        neg_starts = np.concatenate(neg_starts)
+        neg_df = pd.DataFrame({'start' : neg_starts,
+                               'stop' : neg_starts + self.length,
+                               'chrom' : np.concatenate(chroms),
+                               'nb_windows' : np.concatenate(neg_windows)})
         neg_df['label'] = 0
         neg_df['type'] = 0
 
         if 'strand' in self.ann_df.columns:
-            neg_df['strand'] = np.random.choice(['+', '-'], len(neg_df))
-
-        nb_types = len(self.ann_df.type.unique())
-        nb_labels = len(self.ann_df.label.unique())
+            neg_df['strand'] = rng.choice(['+', '-'], len(neg_df))
+        return neg_df
+
+    def _resampled_negative_class(self):
+        """
+        Keeps the gaps between the positive windows of the genome and returns
+        a single row holding all the negative windows, those windows are drawn
+        in the gaps when they are asked (see _draw_negatives).
+        """
+        chroms, starts, lengths = list(), list(), list()
+        number_of_neg = 0
+
+        for chrom, gap_starts, gap_lengths, number_of_pos in self._negative_gaps():
+            chroms.append(np.repeat(chrom, len(gap_starts)))
+            starts.append(gap_starts)
+            lengths.append(gap_lengths)
+            number_of_neg += number_of_pos * self.negative_ratio
+
+        self.gap_chroms = np.concatenate(chroms).astype(str)
+        self.gap_starts = np.concatenate(starts).astype(np.int64)
+        self.gap_lengths = np.concatenate(lengths).astype(np.int64)
+
+        assert len(self.gap_starts) > 0,\
+        """No room was found between the positive windows to draw negative
+        windows"""
+
+        neg_df = pd.DataFrame({'start' : [0],
+                               'stop' : [self.length],
+                               'chrom' : [self.gap_chroms[0]],
+                               'nb_windows' : [number_of_neg]})
+        neg_df['label'] = 0
+        neg_df['type'] = 0
 
-        if self.seq2seq:
-            labels = np.zeros((len(neg_df),
-                                self.length,
-                                nb_types,
-                                nb_labels))
+        if 'strand' in self.ann_df.columns:
+            neg_df['strand'] = '+'
+        return neg_df
+
+    def _matched_negative_class(self, max_rounds=20):
+        """
+        Returns negative windows drawn in the gaps between the positive
+        windows, stratified so that the distribution of their GC content
+        (and mappability) classes matches the one of the positive windows.
+        Candidates are drawn by pools, the ones of the classes that still
+        need windows are kept.
+        """
+        if GCIndex.is_index(self.gc_index):
+            index = GCIndex(self.gc_index)
         else:
-            labels = np.zeros((len(neg_df),
-                                nb_types,
-                                nb_labels))
-
-        return neg_df, labels
-
-    def _get_translation_dico(self):
-        trans_dico = {}
-
-        for chrom in self.ann_df.chrom.unique():
-            df_ = self.ann_df[self.ann_df.chrom == chrom]
-            starts = df_.start.values
-            stops = df_.stop.values
-
-            if self.data_augmentation:
-                len_per_ann = [max(stops[i] - starts[i] - self.length,
-                                   starts[i] - stops[i] + self.length + 1) for i in range(len(starts))]
-                base_index = np.cumsum(len_per_ann)
-                trans_dico[chrom] = {i : np.arange(base_index[i - 1], base_index[i]) \
-                                     for i in range(len(starts))}
+            index = GCIndex(compile_gc_index(self.gc_index))
+
+        pos_strata = self._gc_strata(index,
+                                     self.df.chrom.values,
+                                     self.df.start.values,
+                                     self.df.stop.values)
+        nb_strata = self.gc_strata * self.mappability_strata
+
+        chroms, starts, lengths = list(), list(), list()
+        number_of_neg = 0
+        for chrom, gap_starts, gap_lengths, number_of_pos in self._negative_gaps():
+            chroms.append(np.repeat(chrom, len(gap_starts)))
+            starts.append(gap_starts)
+            lengths.append(gap_lengths)
+            number_of_neg += number_of_pos * self.negative_ratio
+
+        assert sum(len(gap_starts) for gap_starts in starts) > 0,\
+        """No room was found between the positive windows to draw negative
+        windows"""
+
+        self.gap_chroms = np.concatenate(chroms).astype(str)
+        self.gap_starts = np.concatenate(starts).astype(np.int64)
+        self.gap_lengths = np.concatenate(lengths).astype(np.int64)
+
+        proportions = np.bincount(pos_strata[pos_strata >= 0], minlength=nb_strata)
+        proportions = proportions / max(np.sum(proportions), 1)
+        need = np.round(proportions * number_of_neg).astype(np.int64)
+
+        rng = self._build_rng()
+        neg_chroms, neg_starts = list(), list()
+        for _ in range(max_rounds):
+            if np.sum(need) == 0:
+                break
+            chroms, starts = self._draw_negatives(4 * int(np.sum(need)), rng)
+            strata = self._gc_strata(index, chroms, starts, starts + self.length)
+
+            # the candidates are grouped by class in a random order, the first
+            # ones of every class are kept
+            order = np.lexsort((rng.random(len(strata)), strata))
+            strata = strata[order]
+            rank = np.arange(len(strata)) - np.searchsorted(strata, strata)
+            keep = (strata >= 0) & (rank < need[np.maximum(strata, 0)])
+
+            neg_chroms.append(chroms[order][keep])
+            neg_starts.append(starts[order][keep])
+            need -= np.bincount(strata[keep], minlength=nb_strata)
+
+        if np.sum(need) > 0:
+            warnings.warn("""{} negative windows could not be matched on GC content
+                          and are missing""".format(np.sum(need)))
+        del self.gap_chroms, self.gap_starts, self.gap_lengths
+
+        neg_starts = np.concatenate(neg_starts) if neg_starts else np.zeros(0, dtype=np.int64)
+        neg_df = pd.DataFrame({'start' : neg_starts,
+                               'stop' : neg_starts + self.length,
+                               'chrom' : np.concatenate(neg_chroms) if neg_chroms else []})
+        neg_df['label'] = 0
+        neg_df['type'] = 0
 
-                trans_dico[chrom][0] = np.arange(base_index[0])
-            else:
-                trans_dico[chrom] = {i : [i] for i in range(len(starts))}
-        return trans_dico
+        if 'strand' in self.ann_df.columns:
+            neg_df['strand'] = rng.choice(['+', '-'], len(neg_df))
+        return neg_df
+
+    def _gc_strata(self, index, chroms, starts, stops):
+        """
+        Returns the class of GC content and mappability of windows, -1 for
+        windows only made of N.
+        """
+        gc, mappability = index.window_stats(chroms, starts, stops)
+
+        strata = np.minimum(np.nan_to_num(gc) * self.gc_strata,
+                            self.gc_strata - 1).astype(np.int64)
+        strata *= self.mappability_strata
+        if mappability is not None:
+            strata += np.minimum(mappability * self.mappability_strata,
+                                 self.mappability_strata - 1).astype(np.int64)
+        strata[np.isnan(gc)] = -1
+        return strata
+
+    def _build_rng(self):
+        """
+        Returns the random generator of the negative windows drawn when the
+        dataset is built, seeded by the seed of the dataset.
+        """
+        return np.random.default_rng(np.random.SeedSequence(int(self.seed)))
+
+    def _batch_rng(self, idx):
+        """
+        Returns the random generator of the negative windows of a batch. It is
+        seeded by the seed of the dataset, the epoch and the first window of
+        the batch (the batches of an epoch do not share windows), so that
+        the draws do not depend on the process or the thread building the
+        batch.
+        """
+        seed = np.random.SeedSequence(int(self.seed),
+                                      spawn_key=(self.epoch, int(idx[0])))
+        return np.random.default_rng(seed)
+
+    def set_epoch(self, epoch):
+        """Sets the epoch, the negative windows drawn change with it."""
+        self.epoch = epoch
+
+    def _draw_negatives(self, number, rng):
+        """
+        Draws number negative windows uniformly among the windows of the gaps
+        with the random generator rng, returns their chromosomes and starts.
+        """
+        gap_ends = np.cumsum(self.gap_lengths)
+        offsets = rng.integers(0, gap_ends[-1], number)
+        gap_idx = np.searchsorted(gap_ends, offsets, side='right')
+
+        starts = self.gap_starts[gap_idx] + offsets - (gap_ends - self.gap_lengths)[gap_idx]
+        return self.gap_chroms[gap_idx], starts
+
+    @staticmethod
+    def _sample_offsets(total, number, rng):
+        """
+        Draws number distinct integers in [0, total) with the random
+        generator rng without allocating np.arange(total), all of them if
+        number >= total.
+        """
+        if number >= total:
+            return np.arange(total)
+
+        offsets = np.unique(rng.integers(0, total, number))
+        while len(offsets) < number:
+            offsets = np.unique(np.append(offsets,
+                                          rng.integers(0, total,
+                                                       number - len(offsets))))
+        return offsets
 
     def _annotation_inter(self):
+        """
+        Splits the annotations of every chromosome between the ones that are
+        isolated and the ones whose start or stop is closer than length (or
+        length // 2 without data_augmentation) to the start or the stop of
+        another annotation. The starts and the stops are sorted so that only
+        the neighbours in the sorted order need to be compared.
+        """
         inter_dict = {}
 
+        if self.data_augmentation:
+            max_dist = self.length
+        else:
+            max_dist = self.length // 2
+
         for chrom in self.ann_df.chrom.unique():
             local_df = self.ann_df[self.ann_df.chrom == chrom]
-            starts = local_df.start.values
-            stops = local_df.stop.values
-            mat_ann_start = np.repeat(starts,
-                                      len(starts)).reshape((len(starts),
-                                                            len(starts)))
-            mat_ann_stop = np.repeat(stops,
-                                     len(stops)).reshape((len(starts),
-                                                          len(starts)))
-
-            if self.defined_positive == 'match_all':
-                A = np.minimum(np.abs(mat_ann_stop - mat_ann_stop.T),
-                               np.abs(mat_ann_start - mat_ann_start.T))
-                m = A.shape[0]
-                strided = np.lib.stride_tricks.as_strided
-                s0, s1 = A.strides
-                out = strided(A.ravel()[1:],
-                              shape=(m - 1, m),
-                              strides=(s0 + s1, s1)).reshape(m, -1)
-            else:
-                A = np.minimum(np.abs(mat_ann_stop - mat_ann_stop.T),
-                               np.abs(mat_ann_start - mat_ann_start.T),
-                               np.abs(mat_ann_start - mat_ann_stop.T))
-                m = A.shape[0]
-                strided = np.lib.stride_tricks.as_strided
-                s0, s1 = A.strides
-                out = strided(A.ravel()[1:],
-                              shape=(m - 1, m),
-                              strides=(s0 + s1, s1)).reshape(m, -1)
-            if self.data_augmentation:
-                indexes = np.where(out <= self.length)[0]
-            else:
-                indexes = np.where(out <= self.length // 2)[0]
+            inter = np.zeros(len(local_df), dtype=bool)
+
+            for positions in (local_df.start.values, local_df.stop.values):
+                order = np.argsort(positions, kind='stable')
+                close = np.diff(positions[order]) <= max_dist
+                inter[order[1:][close]] = True
+                inter[order[:-1][close]] = True
 
-            inter_indexes = np.unique(indexes)
-            inter_dict[chrom] = [np.delete(np.arange(len(starts)), inter_indexes),
-                                 inter_indexes]
+            inter_dict[chrom] = [np.where(~inter)[0],
+                                 np.where(inter)[0]]
         return inter_dict
 
     def _get_dataframe(self):
@@ -537,17 +940,31 @@ class SparseDataset(object):
         for chrom in self.ann_df.chrom.unique():
             df_ = self.ann_df[self.ann_df.chrom == chrom]
 
-            if not self.seq_len == 'real':
+            positions = np.where(self.ann_df.chrom.values == chrom)[0]
+
+            if self.data_augmentation:
+                first_starts, nb_windows = self._window_ranges(df_)
+
+                new_df_ = pd.DataFrame({'start' : first_starts,
+                                        'stop' : first_starts + self.length})
+                new_df_['chrom'] = chrom
+
+                if 'strand' in df_.columns:
+                    new_df_['strand'] = df_.strand.values
+
+                new_df_['nb_windows'] = nb_windows
+                new_df_['ann_index'] = positions
+                new_df = new_df.append(new_df_)
+
+            elif not self.seq_len == 'real':
                 if 'strand' in df_.columns:
                     pos_starts, pos_stops, pos_strands = \
                     self._calculate_interval(df_,
-                                             return_all=True,
                                              return_strand=True)
 
                 else:
                     pos_starts, pos_stops = \
-                    self._calculate_interval(df_,
-                                             return_all=True)
+                    self._calculate_interval(df_)
 
                 new_df_ = pd.DataFrame({'start' : pos_starts,
                                         'stop' : pos_stops})
@@ -556,128 +973,106 @@ class SparseDataset(object):
                 if 'strand' in df_.columns:
                     new_df_['strand'] = pos_strands
 
+                new_df_['ann_index'] = positions
                 new_df = new_df.append(new_df_)
             else:
-                new_df = new_df.append(df_)
+                new_df = new_df.append(df_.assign(ann_index=positions))
         return new_df
 
-    def _get_labels(self):
-        nb_types = len(self.ann_df.type.unique())
-        nb_labels = len(self.ann_df.label.unique())
-        trans_dict = self._get_translation_dico()
-        inter_dict = self._annotation_inter()
+    def _get_inter_annotations(self, inter=None):
+        """
+        Finds the annotations close to another one (see _annotation_inter),
+        the windows of those annotations are labeled by all the close
+        annotations they match, the other ones only by their annotation.
+        """
+        chroms = self.ann_df.chrom.values
+
+        if inter is None:
+            inter = np.zeros(len(self.ann_df), dtype=bool)
+            for chrom, (_, inter_) in self._annotation_inter().items():
+                inter[np.where(chroms == chrom)[0][inter_]] = True
+
+        self.inter = inter
+        self.inter_annotations = {chrom : np.where(inter & (chroms == chrom))[0]\
+                                  for chrom in np.unique(chroms)}
+
+    def _get_window_labels(self, ann_index, starts, stops):
+        """
+        Returns the labels of windows taken around the annotations ann_index
+        (-1 for a negative window). A window of an isolated annotation is
+        labeled by its annotation, a window of a close annotation by all the
+        close annotations of the chromosome that it matches, the matching
+        pairs being found by an overlap join.
+        """
+        labels = self._zero_labels(len(starts))
+        ann_starts = self.ann_df.start.values.astype(np.int64, copy=False)
+        ann_stops = self.ann_df.stop.values.astype(np.int64, copy=False)
+        ann_types = self.ann_df.type.values.astype(int) - 1
+        ann_labels = self.ann_df.label.values.astype(int) - 1
+        ann_chroms = self.ann_df.chrom.values
+
+        positive = ann_index >= 0
+        alone = np.where(positive & ~self.inter[ann_index])[0]
+        anns = ann_index[alone]
 
         if self.seq2seq:
-            labels = np.zeros((1, self.length, nb_types, nb_labels))
+            self._fill_segments(labels,
+                                alone,
+                                np.maximum(0, ann_starts[anns] - starts[alone]),
+                                np.minimum(self.length, ann_stops[anns] - starts[alone]),
+                                ann_types[anns],
+                                ann_labels[anns])
         else:
-            labels = np.zeros((1, nb_types, nb_labels))
+            labels[alone, ann_types[anns], ann_labels[anns]] = 1
 
-        for chrom in self.ann_df.chrom.unique():
-            df_ = self.ann_df[self.ann_df.chrom == chrom]
-            pos_starts, pos_stops = self._calculate_interval(df_,
-                                                             return_all=True)
+        shared = np.where(positive & self.inter[ann_index])[0]
+        shared_chroms = ann_chroms[ann_index[shared]]
 
-            if self.seq2seq:
-                labels_ = np.zeros((len(pos_starts),
-                                    self.length,
-                                    nb_types,
-                                    nb_labels))
-            else:
-                labels_ = np.zeros((len(pos_starts),
-                                    nb_types,
-                                    nb_labels))
-            local_df = self.df[self.df.chrom == chrom]
-            ann_to_df = trans_dict[chrom]
-            no_inter, inter = inter_dict[chrom]
+        for chrom in np.unique(shared_chroms):
+            windows = shared[shared_chroms == chrom]
+            anns = self.inter_annotations[chrom]
 
-            if self.seq2seq:
-                seq_starts = {idx :
-                              np.maximum(np.zeros(len(ann_to_df[idx])).astype(int), 
-                                     df_.start.values[idx] - local_df.start.values[ann_to_df[idx]])\
-                              for idx in no_inter}
-                seq_stops = {idx :
-                             np.minimum(np.ones(len(ann_to_df[idx])).astype(int) * self.length,
-                                    df_.stop.values[idx] - local_df.start.values[ann_to_df[idx]])\
-                             for idx in no_inter}
-
-                labels_[np.concatenate([np.concatenate([np.repeat(ann_to_df[idx][i],
-                                                                  seq_stops[idx][i] - seq_starts[idx][i])\
-                                                       for i in range(len(ann_to_df[idx]))], 0)\
-                                        for idx in no_inter]),
-                        np.concatenate([np.concatenate([np.arange(seq_starts[idx][i],
-                                                                  seq_stops[idx][i])\
-                                                       for i in range(len(ann_to_df[idx]))], 0)\
-                                        for idx in no_inter]),
-                        np.concatenate([np.repeat(df_.type.values[idx] - 1,
-                                                  len(ann_to_df[idx]) *\
-                                                  min(self.length,
-                                                      df_.stop.values[idx] - df_.start.values[idx]))\
-                                        for idx in no_inter]),
-                        np.concatenate([np.repeat(df_.label.values[idx] - 1,
-                                                  len(ann_to_df[idx]) *\
-                                                  min(self.length,
-                                                      df_.stop.values[idx] - df_.start.values[idx]))\
-                                        for idx in no_inter])] = 1
-            else:
-                labels_[np.concatenate([ann_to_df[idx] for idx in no_inter], 0),
-                        np.concatenate([np.repeat(df_.type.values[idx] - 1,
-                                                  len(ann_to_df[idx])) for idx in no_inter], 0),
-                        np.concatenate([np.repeat(df_.label.values[idx] - 1,
-                                                  len(ann_to_df[idx])) for idx in no_inter], 0)] = 1
-            if len(inter) > 0:
-                df_inter = np.concatenate([ann_to_df[idx] for idx in inter])
-                pos_starts = local_df.start.values[df_inter]
-                pos_stops = local_df.stop.values[df_inter]
-
-                ann_starts = df_.start.values[inter]
-                ann_stops = df_.stop.values[inter]
-
-                mat_ann_start = np.repeat(ann_starts,
-                                          len(pos_starts)).\
-                                          reshape(len(ann_starts),
-                                          len(pos_starts)).T
-                mat_int_start = np.repeat(pos_starts,
-                                          len(ann_starts)).\
-                                          reshape(len(pos_starts),
-                                          len(ann_starts))
-
-                mat_ann_stop = np.repeat(ann_stops,
-                                         len(pos_stops)).\
-                                         reshape(len(ann_stops),
-                                         len(pos_stops)).T
-                mat_int_stop = np.repeat(pos_stops,
-                                         len(ann_stops)).\
-                                         reshape(len(pos_stops),
-                                         len(ann_stops))
-
-                if self.seq2seq:
-                    idx_int, idx_ann = np.where(np.sign(mat_ann_start - mat_int_stop) *\
-                                             np.sign(mat_ann_stop - mat_int_start) < 0)
-                    offset_start = mat_ann_start - mat_int_start
-                    offset_start[offset_start < 0] = 0 
-                    offset_stop = self.length - mat_int_stop + mat_ann_stop
-                    offset_stop[offset_stop < 0] = 0
-
-                    for i, j in zip(idx_int, idx_ann):
-                        labels_[df_inter[i],
-                                offset_start[i, j] : offset_stop[i, j],
-                                df_.type.values[inter[j]] - 1,
-                                df_.label.values.astype(int)[inter[j]] - 1] = 1
-
-                else:
-                    if self.defined_positive == 'match_all':
-                        idx_int, idx_ann = np.where(np.sign(mat_ann_start - mat_int_start) *\
-                                                    np.sign(mat_ann_stop - mat_int_stop) <= 0)
-                    else:
-                        idx_int, idx_ann = np.where(np.sign(mat_ann_start - mat_int_stop) *\
-                                             np.sign(mat_ann_stop - mat_int_start) < 0)
+            idx_win, idx_ann, overlap_starts, overlap_stops = \
+            overlap_join(starts[windows],
+                         stops[windows],
+                         ann_starts[anns],
+                         ann_stops[anns])
 
-                    labels_[df_inter[idx_int],
-                            df_.type.values[inter[idx_ann]] - 1,
-                            df_.label.values[inter[idx_ann]].astype(int) - 1] = 1
-            labels = np.append(labels, labels_, axis=0)
+            if not self.seq2seq and self.defined_positive == 'match_all':
+                # the annotation contains the window or is contained in it
+                match = np.sign(ann_starts[anns[idx_ann]] - starts[windows[idx_win]]) *\
+                        np.sign(ann_stops[anns[idx_ann]] - stops[windows[idx_win]]) <= 0
+                idx_win, idx_ann = idx_win[match], idx_ann[match]
 
-        return labels[1:]
+            if self.seq2seq:
+                self._fill_segments(labels,
+                                    windows[idx_win],
+                                    overlap_starts - starts[windows[idx_win]],
+                                    overlap_stops - starts[windows[idx_win]],
+                                    ann_types[anns[idx_ann]],
+                                    ann_labels[anns[idx_ann]])
+            else:
+                labels[windows[idx_win],
+                       ann_types[anns[idx_ann]],
+                       ann_labels[anns[idx_ann]]] = 1
+        return labels
+
+    @staticmethod
+    def _fill_segments(labels, rows, seg_starts, seg_stops, types, ann_labels):
+        """
+        Sets to 1 the positions seg_starts to seg_stops of the rows of a
+        seq2seq label array, for the given types and labels.
+        """
+        lengths = np.maximum(seg_stops - seg_starts, 0)
+        total = np.sum(lengths)
+        if total == 0:
+            return
+
+        shifts = np.repeat(seg_starts - (np.cumsum(lengths) - lengths), lengths)
+        labels[np.repeat(rows, lengths),
+               np.arange(total) + shifts,
+               np.repeat(types, lengths),
+               np.repeat(ann_labels, lengths)] = 1
 
     @property
     def command_dict(self):
@@ -750,6 +1145,38 @@ class ContinuousDataset(object):
             A file with the chromosome name and size usefull to convert wig
             and bedGraph to bigwig.
             default= None
+        cache_coverage:
+            If True, the coverage of every chromosome is read once and kept
+            in memory (or in coverage_cache_dir beyond cache_memory), usefull
+            when the intervals overlap.
+            default=False
+        cache_memory:
+            Maximal number of bytes of coverage kept in memory, None for no
+            limit.
+            default=None
+        coverage_cache_dir:
+            Directory where the coverage exceeding cache_memory is written,
+            default is the temporary directory of the system.
+            default=None
+        approximate_downsampling:
+            If True, the downsampled labels are the means on bins taken from
+            the zoom levels of the bigWig files, much less data is downloaded
+            for long windows. Only used with remote bigWig files (URLs), it
+            is slower on local files (see bbi_extractor).
+            default=False
+        exclude_regions:
+            A bed file with regions to exclude (for example a blacklist), the
+            windows overlapping one of them are removed from the dataset.
+            default=None
+        max_n_fraction:
+            If not None, the windows with a larger fraction of N are removed
+            from the dataset, an n_index is needed.
+            default=None
+        n_index:
+            The runs of N of the genome: a file written by
+            extractors.compile_n_index, or a fasta file whose index is
+            computed once and kept next to it.
+            default=None
     """
     def __init__(self, annotation_files,
                        window,
@@ -763,7 +1190,14 @@ class ContinuousDataset(object):
                        excl_chromosomes=None,
                        start_stop=None,
                        ignore_targets=False,
-                       size=None):
+                       size=None,
+                       cache_coverage=False,
+                       cache_memory=None,
+                       coverage_cache_dir=None,
+                       approximate_downsampling=False,
+                       exclude_regions=None,
+                       max_n_fraction=None,
+                       n_index=None):
         
         self.annotation_files = annotation_files
         self.nb_annotation_type = nb_annotation_type
@@ -780,8 +1214,18 @@ class ContinuousDataset(object):
         self.ignore_targets = ignore_targets
         self.df = pd.DataFrame()
         self.size = size
+        self.cache_coverage = cache_coverage
+        self.cache_memory = cache_memory
+        self.coverage_cache_dir = coverage_cache_dir
+        self.approximate_downsampling = approximate_downsampling
+        self.exclude_regions = exclude_regions
+        self.max_n_fraction = max_n_fraction
+        self.n_index = n_index
         self.frame = inspect.currentframe()
 
+        assert self.max_n_fraction is None or self.n_index is not None,\
+        """To filter the windows on their N content an n_index must be passed"""
+
         # converting to list type to consistancy with the case of multi-outputs
         if not isinstance(self.annotation_files, list):
             self.annotation_files = [self.annotation_files]
@@ -865,7 +1309,11 @@ class ContinuousDataset(object):
                                            self.tg_window,
                                            self.nb_annotation_type,
                                            self.downsampling,
-                                           self.normalization_mode)
+                                           self.normalization_mode,
+                                           cache_coverage=self.cache_coverage,
+                                           cache_memory=self.cache_memory,
+                                           cache_dir=self.coverage_cache_dir,
+                                           approximate_sampling=self.approximate_downsampling)
 
         if self.num_chr and self.df.iloc[0][0].startswith("chr"):
             self.df.chrom = self.df.chrom.str.replace("^chr", "")
@@ -932,6 +1380,10 @@ class ContinuousDataset(object):
                 first_index.append(0)
                 last_index.append((stop[-1] - start[-1]) // self.asteps)
 
+        if self.exclude_regions is not None or self.max_n_fraction is not None:
+            chrom, start, stop, last_index = self._exclude(chrom, start, stop)
+            first_index = [0] * len(chrom)
+
         last_index = np.cumsum(last_index)
         for i in range(len(last_index)):
             last_index[i] += i
@@ -944,30 +1396,88 @@ class ContinuousDataset(object):
                                'last_index' : last_index})
         return new_df
 
+    def _exclude(self, chrom, start, stop):
+        """
+        Splits the range of window centers of every chromosome around the
+        excluded regions. The centers of the windows overlapping a region
+        [a, b) are in [a - hw - window % 2 + 1, b + hw), a row is kept for
+        every piece between them with its first and last center on the grid
+        of step asteps, so that the indexes stay arithmetic. The windows with
+        more than max_n_fraction N are removed the same way (see
+        NIndex.dense_windows).
+        """
+        if self.exclude_regions is not None:
+            regions = RegionIndex(self.exclude_regions)
+        if self.max_n_fraction is not None:
+            n_index = load_n_index(self.n_index)
+        new_chrom, new_start, new_stop, last_index = list(), list(), list(), list()
+
+        for name, start_, stop_ in zip(chrom, start, stop):
+            ex_starts = [np.zeros(0, dtype=np.int64)]
+            ex_stops = [np.zeros(0, dtype=np.int64)]
+
+            if self.exclude_regions is not None:
+                region_starts, region_stops = regions.get(name)
+                ex_starts.append(region_starts - self.hw - (self.window % 2) + 1)
+                ex_stops.append(region_stops + self.hw)
+
+            if self.max_n_fraction is not None:
+                dense_starts, dense_stops = n_index.dense_windows(name,
+                                                                  self.window,
+                                                                  self.max_n_fraction)
+                ex_starts.append(dense_starts)
+                ex_stops.append(dense_stops)
+
+            ex_starts, ex_stops = merge_intervals(np.concatenate(ex_starts),
+                                                  np.concatenate(ex_stops))
+            _, piece_starts, piece_stops = subtract_intervals([start_],
+                                                              [stop_ + 1],
+                                                              ex_starts,
+                                                              ex_stops)
+
+            first_k = -((start_ - piece_starts) // self.asteps)
+            last_k = (piece_stops - 1 - start_) // self.asteps
+            kept = last_k >= first_k
+
+            for k0, k1 in zip(first_k[kept], last_k[kept]):
+                new_chrom.append(name)
+                new_start.append(start_ + k0 * self.asteps)
+                new_stop.append(start_ + k1 * self.asteps)
+                last_index.append(k1 - k0)
+
+        assert len(new_chrom) > 0,\
+        """All the windows are excluded"""
+        return new_chrom, new_start, new_stop, last_index
+
+    def _get_intervals(self, idx):
+        """
+        Returns the IntervalBatch corresponding to an array of indexes, the
+        row of every index is found by a binary search on last_index.
+        """
+        idx = np.asarray(idx, dtype=np.int64)
+        df_idx = np.searchsorted(self.df.last_index.values, idx)
+
+        centers = self.df.start.values[df_idx] +\
+        (idx - self.df.first_index.values[df_idx]) * self.asteps
+        return IntervalBatch(self.df.chrom.values,
+                             df_idx,
+                             centers - self.hw,
+                             centers + self.hw + (self.window % 2))
+
     def _get_interval(self, idx):
-        indicative_mat = (np.sign(self.df.first_index.values - idx)) *\
-                         (np.sign(self.df.last_index.values - idx))
-        df_idx = np.where(indicative_mat <= 0)[0][-1]
-
-        row = self.df.iloc[df_idx]
-        start = row.start + (idx - row.first_index) * self.asteps - self.hw
-        stop = row.start + (idx - row.first_index) * self.asteps + self.hw + (self.window % 2)
-        interval = pybedtools.create_interval_from_list([row.chrom,
-                                                         int(start),
-                                                         int(stop)])
-        return interval
+        return self._get_intervals([idx])[0]
 
     def __getitem__(self, idx):
-        """Returns (pybedtools.Interval, labels)"""
+        """Returns (IntervalBatch, labels)"""
         if not isinstance(idx, list):
             idx = [idx]
 
-        intervals = [self._get_interval(index) for index in idx]
+        intervals = self._get_intervals(idx)
 
         if self.ignore_targets:
             labels = {}
         else:
-            labels = np.array([self.extractor.extract(interval) for interval in intervals])
+            labels = self.extractor.extract_batch(intervals)
 
         return intervals, labels
 
@@ -992,7 +1502,9 @@ class StringSeqIntervalDl(object):
         annotation_files:
             list of file with annotations (wig, bigWig or bedGraph / bed, gff)
         fasta_file:
-            Reference genome FASTA file path.
+            Reference genome FASTA file path, or a genome directory written by
+            extractors.compile_genome (the sequences are then sliced from a
+            memory mapped array).
         force_upper:
             Force uppercase output of sequences
         use_strand:
@@ -1020,6 +1532,11 @@ class StringSeqIntervalDl(object):
             default=None
         sec_normalization_mode:
             How the secondary inputs are normalized.
+        sec_approximate_sampling:
+            If True, the sampled secondary inputs are the means on bins taken
+            from the zoom levels of the bigWig files, only used with remote
+            bigWig files (URLs, see bbi_extractor).
+            default=False
         use_sec_as:
             {'inputs', 'targets'}
             default='inputs'
@@ -1054,6 +1571,7 @@ class StringSeqIntervalDl(object):
                  use_sec_as='inputs',
                  force_upper=False,
                  rc=False,
+                 sec_approximate_sampling=False,
                  *args,
                  **kwargs):
         self.annotation_files = annotation_files
@@ -1070,6 +1588,7 @@ class StringSeqIntervalDl(object):
         self.sec_normalization_mode = sec_normalization_mode
         self.use_sec_as = use_sec_as
         self.rc = rc
+        self.sec_approximate_sampling = sec_approximate_sampling
         self.frame = inspect.currentframe()
 
         assert self.use_sec_as in ['targets', 'inputs'],\
@@ -1078,7 +1597,7 @@ class StringSeqIntervalDl(object):
         if not isinstance(self.annotation_files, list):
             self.annotation_files = [self.annotation_files]
 
-        if self.annotation_files[0].endswith(('.bed', '.gff', 'gff3', 'gtf')):
+        if self.annotation_files[0].endswith(SPARSE_EXTENSIONS):
             self.dataset = SparseDataset(annotation_files = self.annotation_files,
                                          *args,
                                          **kwargs)
@@ -1090,18 +1609,28 @@ class StringSeqIntervalDl(object):
             self.dataset = ContinuousDataset(annotation_files = self.annotation_files,
                                              *args,
                                              **kwargs)
+        try:
+            self.seq_length = int(self.dataset.length)
+        except AttributeError:
+            self.seq_length = int(self.dataset.window)
+
         if self.sec_input_length == 'maxlen':
-            try:
-                self.sec_input_length = self.dataset.length
-            except AttributeError:
-                self.sec_input_length = self.dataset.window
+            self.sec_input_length = self.seq_length
+
+        if GenomeArray.is_genome(self.fasta_file):
+            self.genome = GenomeArray(self.fasta_file,
+                                      use_strand=self.use_strand,
+                                      force_upper=self.force_upper)
+        else:
+            self.genome = None
 
         if self.sec_inputs:
             self.extractor = bbi_extractor(self.sec_inputs,
                                            self.sec_input_length,
                                            self.sec_nb_annotation,
                                            self.sec_sampling_mode,
-                                           self.sec_normalization_mode)
+                                           self.sec_normalization_mode,
+                                           approximate_sampling=self.sec_approximate_sampling)
 
     @classmethod
     def default_dict(cls):
@@ -1159,7 +1688,7 @@ class StringSeqIntervalDl(object):
         if isinstance(input_dict['annotation_files'], str):
             input_dict['annotation_files'] = [input_dict['annotation_files']]
         
-        if input_dict['annotation_files'][0].endswith(('.bed', '.gff', 'gff3', 'gtf')):
+        if input_dict['annotation_files'][0].endswith(SPARSE_EXTENSIONS):
             return SparseDataset.predict_label_shape(**input_dict)
         elif input_dict['annotation_files'][0].endswith(('.wig', '.bw', 'bedGraph')):
             return ContinuousDataset.predict_label_shape(**input_dict)
@@ -1171,54 +1700,106 @@ class StringSeqIntervalDl(object):
     def __len__(self):
         return len(self.dataset)
 
-    def __getitem__(self, idx):
-        if not isinstance(idx, list):
-            idx = [idx]
-
-        self.fasta_extractors = FastaStringExtractor(self.fasta_file,
-                                                     use_strand=self.use_strand,
-                                                     force_upper=self.force_upper)
-
-        intervals, labels = self.dataset[idx]
-        seqs = list()
+    def set_epoch(self, epoch):
+        """Passes the epoch to the dataset (see SparseDataset.set_epoch)."""
+        if hasattr(self.dataset, 'set_epoch'):
+            self.dataset.set_epoch(epoch)
 
-        if self.use_strand:
-            negative_strand = list()
+    def __getitem__(self, idx):
+        ret = self._get_batch(idx)
 
-            assert hasattr(intervals[0], 'strand'),\
-            '''Strand need to be specified to use use_strand'''
+        if self.genome is not None:
+            if self.sec_inputs and self.use_sec_as == 'inputs':
+                ret['inputs'][0] = self._to_string(ret['inputs'][0])
+            else:
+                ret['inputs'] = self._to_string(ret['inputs'])
+        return ret
 
-            for i in range(len(intervals)):
-                interval = intervals[i]
-                if interval.length == 0:
-                    seqs.append(''.join(random.choices('ATGC',
-                                                       k=self.dataset.length)))
-                elif interval.strand == '-':
-                    seqs.append(self.fasta_extractors.extract(interval))
-                    negative_strand.append(i)
-                else:
-                    seqs.append(self.fasta_extractors.extract(interval))
+    @staticmethod
+    def _to_string(seqs):
+        return seqs.view('S{}'.format(seqs.shape[1])).ravel().astype(str)
 
-            if self.dataset.seq2seq == True:
-                labels[negative_strand] = labels[negative_strand, ::-1, :, :]
+    def _extract_string(self, intervals, rng):
+        self.fasta_extractors = get_fasta_extractor(self.fasta_file,
+                                                    use_strand=self.use_strand,
+                                                    force_upper=self.force_upper)
+        seqs = list()
 
-        else:  
-            for interval in intervals:
-                if interval.length == 0:
-                    seqs.append(''.join(random.choices('ATGC',
-                                                       k=self.dataset.length)))
-                else:
-                    seqs.append(self.fasta_extractors.extract(interval) )
+        for chrom, start, stop, strand in zip(intervals.chrom,
+                                              intervals.starts,
+                                              intervals.stops,
+                                              self._get_strands(intervals)):
+            if start == stop:
+                seqs.append(''.join(rng.choice(list('ATGC'),
+                                               self.dataset.length)))
+            else:
+                seqs.append(self.fasta_extractors.extract(Interval(str(chrom),
+                                                                   int(start),
+                                                                   int(stop),
+                                                                   strand=str(strand))))
 
         if self.pad_seq:
                 seqs = [fixed_len(seq,
                              int(self.dataset.length),
                              anchor="center",
                              value="N") for seq in seqs]
+        return seqs
+
+    def _extract_array(self, intervals, rng):
+        seqs = self.genome.extract_intervals(intervals, length=self.seq_length)
+
+        empty = np.where(intervals.lengths == 0)[0]
+        if len(empty) > 0:
+            seqs[empty] = np.frombuffer(b'ATGC', dtype=np.uint8)\
+            [rng.integers(4, size=(len(empty), self.seq_length))]
+        return seqs
+
+    def _batch_rng(self, idx):
+        """
+        Returns the random generator of a batch of a SparseDataset (see
+        SparseDataset._batch_rng), an unseeded one for the other datasets.
+        """
+        if hasattr(self.dataset, '_batch_rng') and len(idx):
+            return self.dataset._batch_rng(idx)
+        return np.random.default_rng()
+
+    @staticmethod
+    def _get_strands(intervals):
+        if intervals.stranded:
+            return intervals.strands
+        else:
+            return np.repeat('.', len(intervals))
+
+    def _get_batch(self, idx):
+        """
+        Returns the batch with the DNA sequences as strings or, if the genome
+        is read from a GenomeArray, as a uint8 array of ASCII codes.
+        """
+        if not isinstance(idx, list):
+            idx = [idx]
+
+        intervals, labels = self.dataset[idx]
+        # draws the sequences of the empty intervals (negative_type='random')
+        rng = self._batch_rng(idx)
+
+        if self.use_strand:
+            strands = self._get_strands(intervals)[intervals.lengths != 0]
+            assert np.all(np.isin(strands, ['+', '-'])),\
+            '''Strand need to be specified to use use_strand'''
+
+            negative_strand = np.where((intervals.lengths != 0) &\
+                                       (self._get_strands(intervals) == '-'))[0]
+
+        if self.genome is not None:
+            seqs = self._extract_array(intervals, rng)
+        else:
+            seqs = self._extract_string(intervals, rng)
+
+        if self.use_strand and self.dataset.seq2seq == True:
+            labels[negative_strand] = labels[negative_strand, ::-1, :, :]
 
         if self.sec_inputs:
-            sec_seqs = [self.extractor.extract(interval) for interval in intervals]
-            sec_seqs = np.array(sec_seqs)
+            sec_seqs = self.extractor.extract_batch(intervals)
             
             if self.use_strand:
                 sec_seqs[negative_strand] = sec_seqs[negative_strand, ::-1]            
@@ -1231,14 +1812,14 @@ class StringSeqIntervalDl(object):
                 sec_seqs = sec_seqs.reshape((sec_seqs.shape[0],) + \
                                              self.sec_input_shape[1:])
             if self.use_sec_as == 'inputs':
-                inputs = [np.array(seqs), sec_seqs]
+                inputs = [np.asarray(seqs), sec_seqs]
             else:
-                inputs = np.array(seqs)
+                inputs = np.asarray(seqs)
                 labels = [labels, sec_seqs]
         else:
             if self.rc:
                 seqs, labels = utils.reverse_complement(seqs, labels)
-            inputs = np.array(seqs)
+            inputs = np.asarray(seqs)
 
         return {
             "inputs": inputs,
@@ -1250,6 +1831,99 @@ class StringSeqIntervalDl(object):
         return utils.ArgumentsDict(self, called_args='dataset')
 
 
+class BatchOneHot(object):
+    """
+    info:
+        doc: >
+            One-hot-encodes a whole batch of DNA sequences at once with a
+            lookup table on the ASCII codes of the bases. The encoding follows
+            kipoiseq.transforms.ReorderedOneHot: the letters of the alphabet
+            are encoded in this order, the neutral letter with neutral_value
+            and any other letter with zeros.
+    args:
+        alphabet:
+            list or string of single letters, default='ACGT'
+        neutral_alphabet:
+            the letter encoded with neutral_value, default='N'
+        neutral_value:
+            default=0.25
+        dtype:
+            numpy dtype of the returned array, default=None (float64)
+        alphabet_axis:
+            axis along which the alphabet runs, default=1
+        dummy_axis:
+            axis where to add a dummy axis, None for no dummy axis.
+            default=None
+    """
+    def __init__(self,
+                 alphabet=DNA,
+                 neutral_alphabet='N',
+                 neutral_value=0.25,
+                 dtype=None,
+                 alphabet_axis=1,
+                 dummy_axis=None):
+        self.alphabet = parse_alphabet(alphabet)
+        self.dtype = parse_dtype(dtype)
+        self.alphabet_axis = alphabet_axis
+        self.dummy_axis = dummy_axis
+
+        assert all(len(letter) == 1 for letter in self.alphabet),\
+        """BatchOneHot can only encode single letter alphabets"""
+
+        self.lookup = np.zeros((256, len(self.alphabet)), dtype=self.dtype)
+        self.lookup[[ord(letter) for letter in self.alphabet]] = np.eye(len(self.alphabet))
+        self.lookup[ord(neutral_alphabet)] = neutral_value
+
+        if self.dummy_axis is not None and self.dummy_axis < 2:
+            self.existing_alphabet_axis = 2
+        else:
+            self.existing_alphabet_axis = 1
+
+    @staticmethod
+    def to_array(seqs):
+        """
+        Converts a list of strings of the same length to a uint8 array of
+        shape (batch, length).
+        """
+        if len(seqs) == 0:
+            return np.zeros((0, 0), dtype=np.uint8)
+        length = len(seqs[0])
+        assert all(len(seq) == length for seq in seqs),\
+        """All the sequences of a batch must have the same length"""
+        return np.frombuffer(''.join(seqs).encode('ascii'),
+                             dtype=np.uint8).reshape((len(seqs), length))
+
+    def output_shape(self, batch_size, length):
+        shape = [length, len(self.alphabet)]
+        if self.dummy_axis is not None:
+            shape.insert(self.dummy_axis, 1)
+        shape[self.existing_alphabet_axis], shape[self.alphabet_axis] =\
+        shape[self.alphabet_axis], shape[self.existing_alphabet_axis]
+        return (batch_size,) + tuple(shape)
+
+    def __call__(self, seqs, out=None):
+        """
+        Encodes a batch of sequences (uint8 array of ASCII codes or list of
+        strings). The result is written in out if it is given, it must be of
+        shape output_shape(batch_size, length).
+        """
+        if not isinstance(seqs, np.ndarray) or seqs.dtype != np.uint8:
+            seqs = self.to_array([str(seq) for seq in seqs])
+
+        if out is None:
+            out = np.empty(self.output_shape(*seqs.shape), dtype=self.lookup.dtype)
+
+        # view of out with the shape (batch, length, alphabet)
+        view = np.swapaxes(out,
+                           self.existing_alphabet_axis + 1,
+                           self.alphabet_axis + 1)
+        if self.dummy_axis is not None:
+            view = view[(slice(None),) * (self.dummy_axis + 1) + (0,)]
+
+        np.take(self.lookup, seqs, axis=0, out=view, mode='clip')
+        return out
+
+
 class SeqIntervalDl(object):
     """
     info:
@@ -1306,23 +1980,36 @@ class SeqIntervalDl(object):
                                                dtype=dtype,
                                                alphabet_axis=alphabet_axis,
                                                dummy_axis=dummy_axis)
+        try:
+            self.encoder = BatchOneHot(alphabet=alphabet,
+                                       dtype=dtype,
+                                       alphabet_axis=alphabet_axis,
+                                       dummy_axis=dummy_axis)
+        except AssertionError:
+            # multi-letter alphabets are encoded sequence by sequence
+            self.encoder = None
 
     def __len__(self):
         return len(self.seq_dl)
 
+    def set_epoch(self, epoch):
+        self.seq_dl.set_epoch(epoch)
+
     def __getitem__(self, idx):
-        ret = self.seq_dl[idx]
+        ret = self.seq_dl._get_batch(idx)
         
         if self.seq_dl.sec_inputs and self.seq_dl.use_sec_as == 'inputs':
-            length = len(ret['inputs'][0])
-            ret['inputs'] = [np.array([self.input_transform(str(ret["inputs"][0][i]))\
-                             for i in range(length)]), ret['inputs'][1]]
+            ret['inputs'] = [self._encode(ret['inputs'][0]), ret['inputs'][1]]
         else:   
-            length = len(ret['inputs'])
-            ret['inputs'] = np.array([self.input_transform(str(ret["inputs"][i]))\
-                            for i in range(length)])
+            ret['inputs'] = self._encode(ret['inputs'])
         return ret
 
+    def _encode(self, seqs):
+        if self.encoder is not None:
+            return self.encoder(seqs)
+        else:
+            return np.array([self.input_transform(str(seq)) for seq in seqs])
+
     @property
     def command_dict(self):
         return utils.ArgumentsDict(self, called_args='seq_dl')
@@ -1359,7 +2046,7 @@ class SeqIntervalDl(object):
         if isinstance(command_dict['annotation_files'], str):
             command_dict['annotation_files'] = [command_dict['annotation_files']]
 
-        if command_dict['annotation_files'][0].endswith(('.bed', '.gff', 'gff3', 'gtf')):
+        if command_dict['annotation_files'][0].endswith(SPARSE_EXTENSIONS):
             assert 'seq_len' in command_dict,\
             """seq_len can not be set as default if we want to anticipate the input shape"""
             assert not isinstance(command_dict['seq_len'], str),\
@@ -1387,7 +2074,7 @@ class SeqIntervalDl(object):
     def input_shape(self):
         command_dict = self.command_dict.as_input()
 
-        if command_dict['annotation_files'][0].endswith(('.bed', '.gff', 'gff3', 'gtf')):
+        if command_dict['annotation_files'][0].endswith(SPARSE_EXTENSIONS):
             command_dict['seq_len'] = self.seq_dl.dataset.length
 
         return self.predict_input_shape(**command_dict)
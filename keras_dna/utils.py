@@ -6,11 +6,49 @@ Created on Wed Jun 26 11:30:24 2019
 @author: routhier
 """
 import numpy as np
-import pybedtools
 import pandas as pd
 import pyBigWig
 import os
+import gzip
 import inspect
+import hashlib
+
+# lookup tables on the ASCII codes of a sequence stored as uint8
+COMPLEMENT = np.arange(256, dtype=np.uint8)
+COMPLEMENT[np.frombuffer(b'ACGTacgt', dtype=np.uint8)] =\
+np.frombuffer(b'TGCAtgca', dtype=np.uint8)
+
+UPPER = np.arange(256, dtype=np.uint8)
+UPPER[ord('a') : ord('z') + 1] -= ord('a') - ord('A')
+
+_checksums = dict()
+
+def file_checksum(path, chunk_size=2 ** 20):
+    """
+    Returns the sha256 of the content of a file, or of the names and the
+    contents of the files of a directory. The checksum is kept for the size
+    and the modification time of the file so that it is read once per
+    process.
+    """
+    if os.path.isdir(path):
+        sha = hashlib.sha256()
+        for name in sorted(os.listdir(path)):
+            if os.path.isfile(os.path.join(path, name)):
+                sha.update(name.encode())
+                sha.update(file_checksum(os.path.join(path, name),
+                                         chunk_size).encode())
+        return sha.hexdigest()
+
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+    if key not in _checksums:
+        sha = hashlib.sha256()
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(chunk_size), b''):
+                sha.update(chunk)
+        _checksums[key] = sha.hexdigest()
+    return _checksums[key]
 
 def get_default_args(func):
     signature = inspect.signature(func)
@@ -20,70 +58,89 @@ def get_default_args(func):
         if v.default is not inspect.Parameter.empty
     }
 
+def _nb_header_lines(path):
+    """Returns the number of track, browser or comment lines heading a file."""
+    opener = gzip.open if path.endswith('.gz') else open
+
+    with opener(path, 'rt') as file:
+        nb_lines = 0
+        for line in file:
+            if not line.startswith(('#', 'track', 'browser')):
+                break
+            nb_lines += 1
+    return nb_lines
+
+def _nb_columns(path, skiprows=0):
+    """Returns the number of tab separated columns of the first record."""
+    opener = gzip.open if path.endswith('.gz') else open
+
+    with opener(path, 'rt') as file:
+        for i, line in enumerate(file):
+            if i >= skiprows and line.strip() and not line.startswith('#'):
+                return len(line.rstrip('\n').split('\t'))
+    return 0
+
 def bed_to_df(bedfile, annotation_list):
-    bedfile = pybedtools.BedTool(bedfile)
-    
+    """
+    Reads a bed file (can be gzipped) into a DataFrame with the columns chrom,
+    start, stop, label and strand ('.' if the file has no strand column).
+    """
     assert len(annotation_list) == 1, \
     """A .bed file can only display the position for one type of 
     annotation."""
-    
-    chroms, starts, stops, labels = [], [], [], []
-    if hasattr(bedfile[0], 'strand'):
-        strands = []
-    
-    for bed in bedfile:
-        chroms.append(bed.chrom)
-        starts.append(bed.start)
-        stops.append(bed.stop)
-        labels.append(annotation_list[0])
-
-        if hasattr(bed, 'strand'):
-            strands.append(bed.strand)
-    
-    if strands:
-        df = pd.DataFrame({'chrom': chroms,
-                           'start': starts,
-                           'stop': stops,
-                           'label': labels,
-                           'strand': strands})
-    else:
-        df = pd.DataFrame({'chrom': chroms,
-                           'start': starts,
-                           'stop': stops,
-                           'label': labels})
-    return df
 
-def gff_to_df(gff_file, annotation_list):
-    gff_file = pybedtools.BedTool(gff_file)
-    
-    chroms, starts, stops, labels = [], [], [], []
-    if not gff_file[1].strand == '.':
-        strands = []
-    else:
-        strands=None
-    
-    gff_file = gff_file.filter(lambda x : x.fields[2] in annotation_list)
-    
-    for gff in gff_file:
-        chroms.append(gff.chrom)
-        starts.append(gff.start)
-        stops.append(gff.stop)
-        labels.append(gff.fields[2])
-        
-        if isinstance(strands, list):
-            strands.append(gff.strand)
-    
-    if isinstance(strands, list):
-        df = pd.DataFrame({'chrom': chroms,
-                           'start': starts,
-                           'stop': stops,
-                           'label': labels,
-                           'strand': strands})
-    else:
-        df = pd.DataFrame({'chrom': chroms,
-                           'start': starts,
-                           'stop': stops,
-                           'label': labels})
+    skiprows = _nb_header_lines(bedfile)
+    # the columns are selected by position, the strand is the sixth one
+    usecols = [column for column in (0, 1, 2, 5)\
+               if column < _nb_columns(bedfile, skiprows)]
+
+    df = pd.read_csv(bedfile,
+                     sep='\t',
+                     header=None,
+                     comment='#',
+                     skiprows=skiprows,
+                     usecols=usecols,
+                     dtype={0 : str, 1 : np.int64, 2 : np.int64, 5 : str})
+    df = df.rename(columns={0 : 'chrom', 1 : 'start', 2 : 'stop', 5 : 'strand'})
+    df['label'] = annotation_list[0]
+
+    if 'strand' not in df.columns:
+        df['strand'] = '.'
+    return df[['chrom', 'start', 'stop', 'label', 'strand']]
+
+def gff_to_df(gff_file, annotation_list, chunksize=10 ** 6):
+    """
+    Reads the features of a gff or gtf file (can be gzipped) whose type is in
+    annotation_list into a DataFrame with the columns chrom, start (0-based),
+    stop, label and strand (if the second feature of the file is stranded).
+    The file is read by chunks, the features are filtered chunk by chunk.
+    """
+    reader = pd.read_csv(gff_file,
+                         sep='\t',
+                         header=None,
+                         comment='#',
+                         usecols=[0, 2, 3, 4, 6],
+                         dtype={0 : str,
+                                2 : str,
+                                3 : np.int64,
+                                4 : np.int64,
+                                6 : str},
+                         chunksize=chunksize)
+
+    chunks = list()
+    stranded = None
+    for chunk in reader:
+        if stranded is None:
+            stranded = len(chunk) < 2 or chunk[6].iloc[1] != '.'
+        chunks.append(chunk[chunk[2].isin(annotation_list)])
+
+    chunk = pd.concat(chunks)
+    df = pd.DataFrame({'chrom': chunk[0].values,
+                       'start': chunk[3].values - 1,
+                       'stop': chunk[4].values,
+                       'label': chunk[2].values})
+    if stranded:
+        df['strand'] = chunk[6].values
     return df
 
 def bedGraph_to_df(bedGraph, chrom_size):
@@ -128,8 +185,11 @@ def reverse_complement_fa(seq):
     return seq
 
 def reverse_complement(seqs, labels, bbi_seqs=None):
-    for i in range(len(seqs)):
-        seqs[i] = reverse_complement_fa(seqs[i])
+    if isinstance(seqs, np.ndarray) and seqs.dtype == np.uint8:
+        seqs = COMPLEMENT[seqs[:, ::-1]]
+    else:
+        for i in range(len(seqs)):
+            seqs[i] = reverse_complement_fa(seqs[i])
     
     if isinstance(labels, np.ndarray):
         labels = labels[:, ::-1]
@@ -0,0 +1,63 @@
+import gzip
+
+from keras_dna.utils import bed_to_df, gff_to_df
+
+
+def test_bed_to_df_six_columns(tmp_path):
+    bed_file = tmp_path / 'peaks.bed'
+    bed_file.write_text('track name=peaks\n'
+                        'chr1\t10\t20\tp1\t0\t+\n'
+                        'chr2\t30\t45\tp2\t0\t-\n')
+
+    df = bed_to_df(str(bed_file), ['peak'])
+
+    assert list(df.columns) == ['chrom', 'start', 'stop', 'label', 'strand']
+    assert list(df.chrom) == ['chr1', 'chr2']
+    assert list(df.start) == [10, 30]
+    assert list(df.stop) == [20, 45]
+    assert list(df.label) == ['peak', 'peak']
+    assert list(df.strand) == ['+', '-']
+
+
+def test_bed_to_df_three_columns(tmp_path):
+    bed_file = tmp_path / 'peaks.bed.gz'
+    with gzip.open(str(bed_file), 'wt') as bed:
+        bed.write('# comment\nchr1\t10\t20\nchr1\t5\t8\n')
+
+    df = bed_to_df(str(bed_file), ['peak'])
+
+    assert list(df.columns) == ['chrom', 'start', 'stop', 'label', 'strand']
+    assert list(df.start) == [10, 5]
+    assert list(df.stop) == [20, 8]
+    assert list(df.strand) == ['.', '.']
+
+
+def test_gff_to_df_filters_by_chunk(tmp_path):
+    gff_file = tmp_path / 'genes.gff.gz'
+    with gzip.open(str(gff_file), 'wt') as gff:
+        gff.write('##gff-version 3\n'
+                  'chr1\tsrc\tgene\t11\t20\t.\t+\t.\tID=g1\n'
+                  'chr1\tsrc\texon\t11\t15\t.\t+\t.\tID=e1\n'
+                  'chr2\tsrc\tgene\t31\t45\t.\t-\t.\tID=g2\n'
+                  'chr2\tsrc\tCDS\t31\t40\t.\t-\t0\tID=c2\n')
+
+    df = gff_to_df(str(gff_file), ['gene', 'CDS'], chunksize=3)
+
+    assert list(df.columns) == ['chrom', 'start', 'stop', 'label', 'strand']
+    assert list(df.chrom) == ['chr1', 'chr2', 'chr2']
+    assert list(df.start) == [10, 30, 30]
+    assert list(df.stop) == [20, 45, 40]
+    assert list(df.label) == ['gene', 'gene', 'CDS']
+    assert list(df.strand) == ['+', '-', '-']
+    assert df.chrom.dtype == object
+
+
+def test_gff_to_df_unstranded(tmp_path):
+    gff_file = tmp_path / 'genes.gtf'
+    gff_file.write_text('chr1\tsrc\tgene\t1\t10\t.\t.\t.\tgene_id "g1";\n'
+                        'chr1\tsrc\tgene\t21\t30\t.\t.\t.\tgene_id "g2";\n')
+
+    df = gff_to_df(str(gff_file), ['gene'])
+
+    assert list(df.columns) == ['chrom', 'start', 'stop', 'label']
+    assert list(df.start) == [0, 20]